@@ -4,24 +4,38 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
+import time
+_IMPORT_STARTED = time.time()
 
 import logging
+from datetime import date, datetime
 import endpoints
 import utils
+import counters
+import dictionaries
+import gamecache
+import highscores
+import leaderboards
+import solver
+import instrumentation
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
-from models import User, Game, Score, Move
+from models import User, Game, Score, UserStats, LEADERBOARD_SIZE,\
+    ACTIVE_GAMES_COUNTERS
 from models import StringMessage, NewGameForm, GameForm, GameMessageForm, MakeMoveForm,\
-    GuessAnswerForm, ScoreForms, GameForms, RankingForms, MoveForms
+    MakeMovesForm, GameMovesForm, GuessAnswerForm, HintForm, UserStatsForm, ScoreForm, ScoreForms, GameForms, RankingForm, RankingForms, MoveForms
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    version=messages.IntegerField(2),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
 GUESS_ANSWER_REQUEST = endpoints.ResourceContainer(
     GuessAnswerForm,
     urlsafe_game_key=messages.StringField(1),)
@@ -29,10 +43,27 @@ USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2),)
 GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    version=messages.IntegerField(2),)
 HIGH_SCORES_REQUEST = endpoints.ResourceContainer(
     number_of_results=messages.IntegerField(1),)
+WINDOW_RANKINGS_REQUEST = endpoints.ResourceContainer(
+    date=messages.StringField(1),
+    number_of_results=messages.IntegerField(2),)
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2),)
+USER_STATS_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),)
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3),)
+
+MAX_HIGHSCORES = highscores.SIZE
+MAX_MOVES_PER_REQUEST = 26
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
 
 @endpoints.api(name='hangman', version='v1')
 class HangmanApi(remote.Service):
@@ -43,45 +74,66 @@ class HangmanApi(remote.Service):
                       name='create_user',
                       http_method='POST')
     def create_user(self, request):
-        """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        """Create a User. Requires a username that is unique regardless of
+        case"""
+        if not request.user_name or not request.user_name.strip():
+            raise endpoints.BadRequestException('A user_name is required!')
+        if User.get_by_name(request.user_name):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        utils.run_in_transaction(self._create_user, request.user_name,
+                                 request.email)
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
+    @staticmethod
+    def _create_user(user_name, email):
+        """Stores a new User keyed by its name. Runs in a transaction, so two
+        requests can't both create the same name."""
+        key = User.key_for_name(user_name)
+        if key.get():
+            raise endpoints.ConflictException(
+                    'A User with that name already exists!')
+        User(key=key, name=user_name, email=email).put()
+
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameMessageForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @ndb.synctasklet
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = yield User.get_by_name_async(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
 
-        game = Game.new_game(user, request.attempts)
+        try:
+            game = Game.new_game(user, request.attempts,
+                                 request.word_length, request.difficulty)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
 
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        return game.to_form('Good luck playing Hangman!')
+        form = yield game.to_form_async('Good luck playing Hangman!',
+                                        user_name=user.name)
+        raise ndb.Return(form)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameMessageForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @ndb.synctasklet
     def get_game(self, request):
-        """Return the current game state."""
-        game = utils.get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return the current game state, flagged not_modified if the client
+        already has the current version of the game"""
+        game_key = utils.get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, user_name = yield gamecache.get_async(game_key)
         if game:
-            return game.to_form('Time to make a move!')
+            form = yield game.to_form_async('Time to make a move!', user_name)
+            form.not_modified = self._is_current(request, game)
+            raise ndb.Return(form)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -92,34 +144,163 @@ class HangmanApi(remote.Service):
                       http_method='PUT')
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = utils.get_by_urlsafe(request.urlsafe_game_key, Game)
+        game_key = utils.get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, user_name = gamecache.get(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
-            return game.to_form('Game already over!')
+            return game.to_form('Game already over!', user_name)
 
-        if not utils.valid_letter_guess(request.letter_guess, game.guessed_letters):
-            return game.to_form('Sorry, %s is an invalid guess!' % request.letter_guess)
+        game, message = utils.run_in_transaction(self._make_move, game_key,
+                                                 request.letter_guess,
+                                                 user_name)
+        return game.to_form(message, user_name)
 
-        game.attempts_remaining -= 1
-        game.guessed_letters = game.guessed_letters + request.letter_guess
+    @staticmethod
+    def _load_game(game_key, user_name):
+        """Reads a game inside a move's transaction. The owner's name, read
+        through the game cache before the transaction, is kept on the game
+        so its put can fill a missing cache entry.
+        Raises:
+            endpoints.NotFoundException: If the game does not exist"""
+        game = game_key.get()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        game.owner_name = user_name
+        return game
 
-        move = Move(game=game.key, move=request.letter_guess, move_index=game.attempts_allowed - game.attempts_remaining)
-        move.put()
+    @staticmethod
+    def _make_move(game_key, letter_guess, user_name):
+        """Applies a letter guess to a game. Runs in a transaction and writes
+        every changed entity with one put_multi.
+        Returns:
+            A (game, message) tuple."""
+        game = HangmanApi._load_game(game_key, user_name)
+        if game.game_over:
+            return game, 'Game already over!'
+
+        attempts_remaining = game.attempts_remaining
+        message, entities = HangmanApi._apply_letter_guess(game, letter_guess,
+                                                           user_name)
+        Game.count_attempts_used(attempts_remaining - game.attempts_remaining)
+        ndb.put_multi(entities)
+        return game, message
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=GameMovesForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    def make_moves(self, request):
+        """Makes several letter guesses in order, stopping once the game is
+        won or lost. Returns the final game state with a message per guess"""
+        if len(request.letter_guesses) > MAX_MOVES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                'At most %d letter guesses can be made at once!'
+                % MAX_MOVES_PER_REQUEST)
+        game_key = utils.get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, user_name = gamecache.get(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            return game.to_moves_form(['Game already over!'], user_name)
 
-        if utils.guessed_letters_are_correct(game.guessed_letters, game.target):
-            game.end_game(True)
-            return game.to_form('You win!')
+        game, move_messages = utils.run_in_transaction(
+            self._make_moves, game_key, request.letter_guesses, user_name)
+        return game.to_moves_form(move_messages, user_name)
 
-        if request.letter_guess in game.target:
-            msg = 'That letter is in the word! Remaining %s' % utils.show_hyphenated_progress(game.guessed_letters, game.target)
+    @staticmethod
+    def _make_moves(game_key, letter_guesses, user_name):
+        """Applies letter guesses to a game in order. Runs in a transaction,
+        loads the game once and writes every changed entity with one
+        put_multi.
+        Returns:
+            A (game, move_messages) tuple."""
+        game = HangmanApi._load_game(game_key, user_name)
+        if game.game_over:
+            return game, ['Game already over!']
+
+        move_messages = []
+        entities = []
+        attempts_remaining = game.attempts_remaining
+        changed = set()
+        for letter_guess in letter_guesses:
+            if game.game_over:
+                break
+            message, guess_entities = HangmanApi._apply_letter_guess(
+                game, letter_guess, user_name)
+            move_messages.append(message)
+            for entity in guess_entities:
+                if id(entity) not in changed:
+                    changed.add(id(entity))
+                    entities.append(entity)
+        Game.count_attempts_used(attempts_remaining - game.attempts_remaining)
+        ndb.put_multi(entities)
+        return game, move_messages
+
+    @staticmethod
+    def _is_current(request, game):
+        """Returns True if the request's version is the game's current
+        version"""
+        return request.version is not None and request.version == game.version
+
+    @staticmethod
+    def _apply_letter_guess(game, letter_guess, user_name):
+        """Applies a letter guess to a loaded game that isn't over, ending it
+        on a win or a loss. Nothing is written here, and the attempt spent is
+        left for the caller to count. user_name is the name of the game's
+        User, read before the transaction.
+        Returns:
+            A (message, entities) tuple, where entities are the changed
+            entities to put."""
+        state = game.get_state()
+        if not state.is_valid_guess(letter_guess):
+            return 'Sorry, %s is an invalid guess!' % letter_guess, []
+
+        game.use_attempt()
+        correct = game.guess_letter(state, letter_guess)
+
+        game.record_move(letter_guess.lower(), correct)
+
+        if state.is_solved():
+            return 'You win!', game.end_game(True, user_name)
+
+        if correct:
+            msg = 'That letter is in the word! Remaining %s' % state.progress()
         else:
-            msg = 'Oops! That letter is not in the word! Remaining %s' % utils.show_hyphenated_progress(game.guessed_letters, game.target)
+            msg = 'Oops! That letter is not in the word! Remaining %s' % state.progress()
 
         if game.attempts_remaining < 1:
-            game.end_game(False)
-            return game.to_form(msg + ' Game over!')
+            return msg + ' Game over!', game.end_game(False)
         else:
-            game.put()
-            return game.to_form(msg)
+            return msg, [game]
+
+    @endpoints.method(request_message=GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @ndb.synctasklet
+    def get_hint(self, request):
+        """Suggests the unguessed letter in the most dictionary words that
+        match the game's revealed letters and contain none of its wrong
+        guesses"""
+        game_key = utils.get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, _ = yield gamecache.get_async(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        form = HintForm(urlsafe_key=request.urlsafe_game_key, candidates=0)
+        if game.game_over:
+            form.message = 'Game already over!'
+            raise ndb.Return(form)
+
+        state = game.get_state()
+        hint = solver.get_solver(dictionaries.get_word_bank()).hint(
+            state.pattern(), state.wrong_letters())
+        form.letter = hint.letter
+        form.candidates = hint.candidates
+        form.message = 'Try {}!'.format(hint.letter)
+        raise ndb.Return(form)
 
     @endpoints.method(request_message=GUESS_ANSWER_REQUEST,
                       response_message=GameMessageForm,
@@ -128,83 +309,216 @@ class HangmanApi(remote.Service):
                       http_method='PUT')
     def guess_answer(self, request):
         """Guesses the answer. Returns a game state with message"""
-        game = utils.get_by_urlsafe(request.urlsafe_game_key, Game)
+        game_key = utils.get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, user_name = gamecache.get(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
-            return game.to_form('Game already over!')
+            return game.to_form('Game already over!', user_name)
 
-        if not utils.valid_word_guess(request.word_guess):
-            return game.to_form('Sorry, %s is an invalid guess!' % request.guess)
+        game, message = utils.run_in_transaction(self._guess_answer, game_key,
+                                                 request.word_guess,
+                                                 user_name)
+        return game.to_form(message, user_name)
 
-        game.attempts_remaining -= 1
-        move = Move(game=game.key, move=request.word_guess, move_index=game.attempts_allowed - game.attempts_remaining)
-        move.put()
+    @staticmethod
+    def _guess_answer(game_key, word_guess, user_name):
+        """Applies a word guess to a game. Runs in a transaction and writes
+        every changed entity with one put_multi.
+        Returns:
+            A (game, message) tuple."""
+        game = HangmanApi._load_game(game_key, user_name)
+        if game.game_over:
+            return game, 'Game already over!'
+
+        if not utils.valid_word_guess(word_guess):
+            return game, 'Sorry, %s is an invalid guess!' % word_guess
 
-        if request.word_guess == game.target:
-            game.end_game(True)
-            return game.to_form('You win!')
+        game.use_attempt()
+        Game.count_attempts_used(1)
+        game.record_move(word_guess, word_guess == game.target)
+
+        if word_guess == game.target:
+            ndb.put_multi(game.end_game(True, user_name))
+            return game, 'You win!'
         else:
-            msg = 'Oops! That is not the word! Remaining %s' % utils.show_hyphenated_progress(game.guessed_letters, game.target)
+            msg = 'Oops! That is not the word! Remaining %s' % game.get_state().progress()
 
         if game.attempts_remaining < 1:
-            game.end_game(False)
-            return game.to_form(msg + ' Game over!')
+            ndb.put_multi(game.end_game(False))
+            return game, msg + ' Game over!'
         else:
             game.put()
-            return game.to_form(msg)
+            return game, msg
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @ndb.synctasklet
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
-
-    @endpoints.method(response_message=RankingForms,
+        """Return a page of scores"""
+        scores, next_cursor = yield utils.fetch_page_async(Score.query(),
+                                                           request.page_size,
+                                                           request.cursor)
+        forms = yield self._score_forms_async(scores)
+        forms.next_cursor = next_cursor
+        raise ndb.Return(forms)
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=RankingForms,
                       path='rankings',
                       name='get_rankings',
                       http_method='GET')
+    @ndb.synctasklet
     def get_rankings(self, request):
-        """Return all rankings"""
-        return RankingForms(items=[user.to_ranking_form() for user in User.query()])
+        """Return a page of rankings, highest rank first. The first page is
+        served from the cached leaderboard when it fits in it."""
+        page_size = utils.get_page_size(request.page_size)
+        if not request.cursor and page_size <= LEADERBOARD_SIZE:
+            leaderboard = User.get_leaderboard()
+            page = leaderboard[:page_size]
+            next_cursor = None
+            if page and (len(leaderboard) > page_size or
+                         len(leaderboard) == LEADERBOARD_SIZE):
+                next_cursor = page[-1][2]
+            raise ndb.Return(RankingForms(
+                items=[RankingForm(user_name=name, rank=rank)
+                       for name, rank, _ in page],
+                next_cursor=next_cursor))
+
+        users, next_cursor = yield utils.fetch_page_async(
+            User.query().order(-User.rank), page_size, request.cursor)
+        totals = User.get_counter_totals(users)
+        raise ndb.Return(RankingForms(
+            items=[user.to_ranking_form(totals[user.key]) for user in users],
+            next_cursor=next_cursor))
+
+    @endpoints.method(request_message=WINDOW_RANKINGS_REQUEST,
+                      response_message=RankingForms,
+                      path='rankings/daily',
+                      name='get_daily_rankings',
+                      http_method='GET')
+    @ndb.synctasklet
+    def get_daily_rankings(self, request):
+        """Return the top users of a day, by wins minus losses that day"""
+        forms = yield self._window_rankings_async(leaderboards.DAY, request)
+        raise ndb.Return(forms)
+
+    @endpoints.method(request_message=WINDOW_RANKINGS_REQUEST,
+                      response_message=RankingForms,
+                      path='rankings/weekly',
+                      name='get_weekly_rankings',
+                      http_method='GET')
+    @ndb.synctasklet
+    def get_weekly_rankings(self, request):
+        """Return the top users of an ISO week, by wins minus losses that
+        week"""
+        forms = yield self._window_rankings_async(leaderboards.WEEK, request)
+        raise ndb.Return(forms)
+
+    @staticmethod
+    @ndb.tasklet
+    def _window_rankings_async(window, request):
+        """Returns a Future for the RankingForms of the window containing the
+        requested date (today by default), limited by the number of results
+        requested and by leaderboards.LEADERBOARD_SIZE"""
+        day = date.today()
+        if request.date:
+            try:
+                day = datetime.strptime(request.date, '%Y-%m-%d').date()
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'date must be in YYYY-MM-DD format!')
+        number_of_results = utils.get_number_of_results(
+            request.number_of_results, leaderboards.LEADERBOARD_SIZE)
+        entries = yield leaderboards.get_async(window, day)
+        raise ndb.Return(RankingForms(items=[
+            RankingForm(user_name=user_name, rank=rank)
+            for user_name, rank, _, _ in entries[:number_of_results]]))
 
     @endpoints.method(request_message=HIGH_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='highscores',
                       name='get_highscores',
                       http_method='GET')
+    @ndb.synctasklet
     def get_highscores(self, request):
-        """Return highest scores, limited by the number of results requested"""
-        highscores = Score.query().order(Score.guesses).fetch(request.number_of_results)
-        return ScoreForms(items=[score.to_form() for score in highscores])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return the best winning scores, fewest guesses first, limited by the
+        number of results requested and by MAX_HIGHSCORES. Served from the
+        high scores list without a query."""
+        number_of_results = utils.get_number_of_results(
+            request.number_of_results, MAX_HIGHSCORES)
+        entries = yield highscores.get_async()
+        raise ndb.Return(ScoreForms(items=[
+            ScoreForm(user_name=entry['user_name'], date=entry['date'],
+                      won=True, guesses=entry['guesses'])
+            for entry in entries[:number_of_results]]))
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @ndb.synctasklet
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's scores"""
+        user = yield User.get_by_name_async(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        scores, next_cursor = yield utils.fetch_page_async(
+            Score.query(Score.user == user.key), request.page_size,
+            request.cursor)
+        raise ndb.Return(ScoreForms(items=[score.to_form(user.name)
+                                           for score in scores],
+                                    next_cursor=next_cursor))
+
+    @endpoints.method(request_message=USER_STATS_REQUEST,
+                      response_message=UserStatsForm,
+                      path='users/{user_name}/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @ndb.synctasklet
+    def get_user_stats(self, request):
+        """Returns the totals, win rate and recent form of a User's games"""
+        if not request.user_name or not request.user_name.strip():
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        # Users keyed by name need just the one batched get of the User and
+        # their stats.
+        user_key = User.key_for_name(request.user_name)
+        user, stats = yield (user_key.get_async(),
+                             UserStats.key_for_user(user_key).get_async())
+        if not user:
+            user = yield User.get_by_name_async(request.user_name)
+            if not user:
+                raise endpoints.NotFoundException(
+                        'A User with that name does not exist!')
+            stats = yield UserStats.key_for_user(user.key).get_async()
+        stats = stats or UserStats()
+        totals = User.get_counter_totals([user])[user.key]
+        raise ndb.Return(stats.to_form(user.name, totals['active_games']))
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @ndb.synctasklet
     def get_user_games(self, request):
-        """Returns all of an individual User's active games"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's active games"""
+        user = yield User.get_by_name_async(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key, Game.game_over == False)
-        return GameForms(items=[game.to_form() for game in games])
+        games, next_cursor = yield utils.fetch_page_async(
+            Game.query(Game.user == user.key, Game.game_over == False),
+            request.page_size, request.cursor)
+        raise ndb.Return(GameForms(items=[game.to_form(user_name=user.name)
+                                          for game in games],
+                                   next_cursor=next_cursor))
 
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=StringMessage,
@@ -213,44 +527,87 @@ class HangmanApi(remote.Service):
                       http_method='PUT')
     def cancel_game(self, request):
         """Cancels an active game"""
-        game = utils.get_by_urlsafe(request.urlsafe_game_key, Game)
-
+        game_key = utils.get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, user_name = gamecache.get(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
             return StringMessage(message='Game already over!')
-        else:
-            game.end_game(False)
-            return StringMessage(message='Game successfully cancelled, Please start a new game!')
 
-    @endpoints.method(request_message=GAME_REQUEST,
+        return StringMessage(
+            message=utils.run_in_transaction(self._cancel_game, game_key,
+                                             user_name))
+
+    @staticmethod
+    def _cancel_game(game_key, user_name):
+        """Ends a game as lost. Runs in a transaction.
+        Returns:
+            The message to show."""
+        game = HangmanApi._load_game(game_key, user_name)
+        if game.game_over:
+            return 'Game already over!'
+        ndb.put_multi(game.end_game(False))
+        return 'Game successfully cancelled, Please start a new game!'
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=MoveForms,
                       path='games/history/{urlsafe_game_key}',
                       name='show_game_history',
                       http_method='GET')
+    @ndb.synctasklet
     def show_game_history(self, request):
-        """Shows the history of a particular game"""
-        game = utils.get_by_urlsafe(request.urlsafe_game_key, Game)
-        moves = Move.query(Move.game == game.key).order(Move.move_index)
-        return MoveForms(items=[move.to_form() for move in moves])
+        """Shows the history of a particular game. If the client already has
+        the current version of the game, the moves are left out and the
+        form is flagged not_modified instead."""
+        game_key = utils.get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, _ = yield gamecache.get_async(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if self._is_current(request, game):
+            raise ndb.Return(MoveForms(version=game.version,
+                                       not_modified=True))
+        raise ndb.Return(MoveForms(items=[move.to_form()
+                                          for move in game.moves],
+                                   version=game.version))
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
+        """Get the average moves remaining from the active games counters"""
+        average = Game.get_average_attempts()
+        if average is None:
+            return StringMessage(message='')
+        return StringMessage(
+            message='The average moves remaining is {:.2f}'.format(average))
+
+    @staticmethod
+    @ndb.tasklet
+    def _score_forms_async(scores):
+        """Builds ScoreForms for a page of Scores, fetching their Users with
+        one batched get instead of one get per Score"""
+        user_names = yield utils.get_user_names_async(scores)
+        raise ndb.Return(ScoreForms(
+            items=[score.to_form(user_names.get(score.user))
+                   for score in scores]))
 
     @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                        for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
-
-
-api = endpoints.api_server([HangmanApi])
+    def _reconcile_average_attempts():
+        """Corrects the active games counters from a scan of the active Games.
+        The counters are kept up to date incrementally, so this only needs to
+        run occasionally to repair drift."""
+        count = 0
+        total_attempts_remaining = 0
+        query = Game.query(Game.game_over == False,
+                           projection=[Game.attempts_remaining])
+        for game in query:
+            count += 1
+            total_attempts_remaining += game.attempts_remaining
+        counters.reconcile(ACTIVE_GAMES_COUNTERS,
+                           {'count': count,
+                            'attempts_remaining': total_attempts_remaining})
+
+
+api = instrumentation.middleware(endpoints.api_server([HangmanApi]))
+instrumentation.record_startup('api', _IMPORT_STARTED)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Local load test of the HangmanApi on the App Engine testbed
+stubs.
+
+Simulates many users playing interleaved games through the endpoints, each
+bot asking get_hint for its next letter, and reports, for each endpoint,
+latency percentiles and the datastore RPCs, entities read and entities
+written per call. Results can be saved as a
+baseline; later runs fail if an endpoint regresses against it.
+
+Usage:
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine
+    python benchmark.py --sdk ... --save-baseline
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+
+class EndpointStats(object):
+    """Latencies and RPC costs recorded for one endpoint"""
+    __slots__ = ('latencies', 'datastore_rpcs', 'entities_read',
+                 'entities_written', 'memcache_hits', 'memcache_misses')
+
+    def __init__(self):
+        self.latencies = []
+        self.datastore_rpcs = 0
+        self.entities_read = 0
+        self.entities_written = 0
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+
+    def add(self, request_stats):
+        self.latencies.append(request_stats.total_ms)
+        self.datastore_rpcs += (request_stats.datastore_gets +
+                                request_stats.datastore_puts +
+                                request_stats.datastore_queries +
+                                request_stats.datastore_other)
+        self.entities_read += request_stats.entities_read
+        self.entities_written += request_stats.entities_written
+        self.memcache_hits += request_stats.memcache_hits
+        self.memcache_misses += request_stats.memcache_misses
+
+    def percentile(self, fraction):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+    def summary(self):
+        calls = len(self.latencies)
+        return collections.OrderedDict([
+            ('calls', calls),
+            ('p50_ms', round(self.percentile(0.5), 3)),
+            ('p90_ms', round(self.percentile(0.9), 3)),
+            ('p99_ms', round(self.percentile(0.99), 3)),
+            ('datastore_rpcs', round(float(self.datastore_rpcs) / calls, 3)),
+            ('entities_read', round(float(self.entities_read) / calls, 3)),
+            ('entities_written',
+             round(float(self.entities_written) / calls, 3)),
+            ('memcache_hits', round(float(self.memcache_hits) / calls, 3)),
+            ('memcache_misses',
+             round(float(self.memcache_misses) / calls, 3)),
+        ])
+
+
+class Recorder(object):
+    """Calls endpoints as separate requests, accounting the RPCs each one
+    makes with the instrumentation hooks"""
+
+    def __init__(self):
+        self.stats = collections.defaultdict(EndpointStats)
+
+    def call(self, name, method, request):
+        """Calls an endpoint method as a fresh request and records it"""
+        from google.appengine.ext import ndb
+        import endpoints
+        import instrumentation
+
+        ndb.get_context().clear_cache()
+        instrumentation.start_request(name)
+        try:
+            return method(request)
+        except endpoints.ServiceException:
+            return None
+        finally:
+            self.stats[name].add(instrumentation.finish_request())
+
+
+def setup_testbed(sdk_path):
+    """Puts the SDK on the path and activates the service stubs"""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(
+        __file__)))
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+def run(users, games_per_user, concurrency, seed):
+    """Plays the simulated games. Returns the summary of each endpoint."""
+    import api
+    import instrumentation
+
+    random.seed(seed)
+    instrumentation.install()
+    recorder = Recorder()
+    service = api.HangmanApi()
+
+    user_names = ['player{}'.format(index) for index in range(users)]
+    for user_name in user_names:
+        recorder.call('create_user', service.create_user,
+                      api.USER_REQUEST.combined_message_class(
+                          user_name=user_name,
+                          email='{}@example.com'.format(user_name)))
+
+    pending = [user_name for user_name in user_names
+               for _ in range(games_per_user)]
+    random.shuffle(pending)
+    active = []
+    while pending or active:
+        while pending and len(active) < concurrency:
+            form = recorder.call('new_game', service.new_game,
+                                 api.NEW_GAME_REQUEST.combined_message_class(
+                                     user_name=pending.pop(), attempts=10))
+            if form:
+                active.append([form.urlsafe_key, 0])
+
+        # Every active game makes one move per round, so games interleave as
+        # they would with concurrent players.
+        still_active = []
+        for game in active:
+            urlsafe_key, moves = game
+            if moves and random.random() < 0.05:
+                form = recorder.call(
+                    'guess_answer', service.guess_answer,
+                    api.GUESS_ANSWER_REQUEST.combined_message_class(
+                        urlsafe_game_key=urlsafe_key, word_guess='hangman'))
+            else:
+                hint = recorder.call(
+                    'get_hint', service.get_hint,
+                    api.GAME_REQUEST.combined_message_class(
+                        urlsafe_game_key=urlsafe_key))
+                form = None
+                if hint and hint.letter:
+                    form = recorder.call(
+                        'make_move', service.make_move,
+                        api.MAKE_MOVE_REQUEST.combined_message_class(
+                            urlsafe_game_key=urlsafe_key,
+                            letter_guess=hint.letter))
+            game[1] += 1
+            if form and not form.game_over:
+                still_active.append(game)
+        active = still_active
+
+        recorder.call('get_scores', service.get_scores,
+                      api.PAGE_REQUEST.combined_message_class(page_size=20))
+        recorder.call('get_rankings', service.get_rankings,
+                      api.PAGE_REQUEST.combined_message_class(page_size=20))
+
+    return collections.OrderedDict(
+        (name, recorder.stats[name].summary())
+        for name in sorted(recorder.stats))
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions of results against a baseline"""
+    regressions = []
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        for metric, value in summary.items():
+            # Fewer cache hits is not a regression on its own.
+            if metric in ('calls', 'memcache_hits') or \
+                    metric not in baseline[name]:
+                continue
+            allowed = baseline[name][metric] * (1 + tolerance)
+            # Latency is noisy on a shared machine; RPC counts are not.
+            if metric.endswith('_ms'):
+                allowed = baseline[name][metric] * (1 + 2 * tolerance)
+            if value > allowed:
+                regressions.append('{} {}: {} > baseline {}'.format(
+                    name, metric, value, baseline[name][metric]))
+    return regressions
+
+
+def print_results(results):
+    metrics = ['calls', 'p50_ms', 'p90_ms', 'p99_ms', 'datastore_rpcs',
+               'entities_read', 'entities_written', 'memcache_hits',
+               'memcache_misses']
+    print('{:<16}'.format('endpoint') +
+          ''.join('{:>17}'.format(metric) for metric in metrics))
+    for name, summary in results.items():
+        print('{:<16}'.format(name) +
+              ''.join('{:>17}'.format(summary[metric]) for metric in metrics))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='Path to the App Engine SDK')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--games-per-user', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='Number of games in play at once')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed fractional regression per metric')
+    args = parser.parse_args()
+
+    bed = setup_testbed(args.sdk)
+    try:
+        results = run(args.users, args.games_per_user, args.concurrency,
+                      args.seed)
+    finally:
+        bed.deactivate()
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('Saved baseline to {}'.format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file),
+                              args.tolerance)
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
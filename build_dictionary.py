@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""build_dictionary.py - Packs a word list into the binary format read by
+wordbank.py.
+
+The input is either a JSON list of words, like words.json, or a text file
+with one word per line, which is read a line at a time. Words that aren't
+plain ASCII letters are skipped and duplicates are dropped.
+
+Usage:
+    python build_dictionary.py words.json words.bin
+    python build_dictionary.py /usr/share/dict/words words.bin
+
+Deploy the output as words.bin, or serve it and import it into a running
+app with the /tasks/import_dictionary task."""
+
+import argparse
+import json
+import sys
+
+import wordbank
+
+
+def read_words(path):
+    """Yields the words of a JSON list or a one word per line text file"""
+    with open(path) as words_file:
+        if words_file.read(1) == '[':
+            words_file.seek(0)
+            for word in json.load(words_file):
+                yield word
+            return
+        words_file.seek(0)
+        for line in words_file:
+            yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('input', help='A JSON or text word list')
+    parser.add_argument('output', nargs='?', default=wordbank.PACKED_WORDS_FILE)
+    args = parser.parse_args()
+
+    packed = wordbank.pack_words(read_words(args.input))
+    with open(args.output, 'wb') as packed_file:
+        packed_file.write(packed)
+
+    word_bank = wordbank.WordBank(packed)
+    print('Packed {} words into {} ({} bytes)'.format(
+        len(word_bank), args.output, len(packed)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
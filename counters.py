@@ -0,0 +1,180 @@
+"""counters.py - Sharded counters for statistics that many requests update at
+the same time.
+
+A counter group is a set of named integer counters that are always read and
+written together. Each group is spread over a number of CounterShard
+entities; an update picks one shard at random, so concurrent writers rarely
+touch the same entity group. Totals are cached in memcache and kept up to date
+with incr/decr, so reads usually never touch the datastore. A group can also
+be drained, folding its totals into another entity in one transaction."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import utils
+
+DEFAULT_NUM_SHARDS = 20
+# memcache decr stops at 0 rather than going negative, so cached totals are
+# stored plus this offset; a total would have to fall below -OFFSET to be
+# clamped.
+MEMCACHE_OFFSET = 2 ** 40
+
+
+class CounterShard(ndb.Model):
+    """One shard of a counter group, holding a partial count per counter"""
+    counts = ndb.JsonProperty(default={})
+
+
+def _shard_keys(group, num_shards):
+    return [ndb.Key(CounterShard, '{}:{}'.format(group, index))
+            for index in range(num_shards)]
+
+
+def _memcache_key(group, name):
+    return 'counter_total:{}:{}'.format(group, name)
+
+
+@ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
+def _increment_shard(key, deltas):
+    shard = key.get() or CounterShard(key=key)
+    counts = dict(shard.counts)
+    for name, delta in deltas.items():
+        counts[name] = counts.get(name, 0) + delta
+    shard.counts = counts
+    shard.put()
+
+
+def increment(group, deltas, num_shards=DEFAULT_NUM_SHARDS):
+    """Adds to counters of a group. Negative deltas are allowed. When called
+    inside a transaction the update is applied once the transaction commits,
+    so it is not repeated when the transaction is retried.
+    Args:
+        group: The name of the counter group
+        deltas: A dict mapping counter names to the amount to add
+        num_shards: The number of shards the group is spread over
+    """
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(
+            lambda: _increment(group, deltas, num_shards))
+    else:
+        _increment(group, deltas, num_shards)
+
+
+def _increment(group, deltas, num_shards):
+    key = _shard_keys(group, num_shards)[random.randrange(num_shards)]
+    _increment_shard(key, deltas)
+
+    # Only adjust totals that are already cached; missing totals are
+    # recomputed from the shards on the next read.
+    for name, delta in deltas.items():
+        if delta > 0:
+            memcache.incr(_memcache_key(group, name), delta)
+        else:
+            memcache.decr(_memcache_key(group, name), -delta)
+
+
+def get_counts(group, names, num_shards=DEFAULT_NUM_SHARDS):
+    """Returns the totals of counters in a group.
+    Args:
+        group: The name of the counter group
+        names: The counter names to read
+        num_shards: The number of shards the group is spread over
+    Returns:
+        A dict mapping each counter name to its total.
+    """
+    return get_counts_multi([group], names, num_shards)[group]
+
+
+def get_counts_multi(groups, names, num_shards=DEFAULT_NUM_SHARDS):
+    """Returns the totals of the same counters in several groups, with one
+    memcache get and at most one datastore get.
+    Args:
+        groups: The names of the counter groups
+        names: The counter names to read in each group
+        num_shards: The number of shards each group is spread over
+    Returns:
+        A dict mapping each group to a dict mapping each counter name to its
+        total.
+    """
+    memcache_keys = dict((_memcache_key(group, name), (group, name))
+                         for group in groups for name in names)
+    cached = memcache.get_multi(memcache_keys.keys())
+    totals = dict((group, {}) for group in groups)
+    for key, value in cached.items():
+        group, name = memcache_keys[key]
+        totals[group][name] = value - MEMCACHE_OFFSET
+
+    missing = [(group, name) for group in groups for name in names
+               if name not in totals[group]]
+    if missing:
+        missing_groups = sorted(set(group for group, _ in missing))
+        shard_keys = [_shard_keys(group, num_shards)
+                      for group in missing_groups]
+        shards = ndb.get_multi([key for keys in shard_keys for key in keys])
+        group_shards = dict(
+            (group, shards[index * num_shards:(index + 1) * num_shards])
+            for index, group in enumerate(missing_groups))
+        for group, name in missing:
+            totals[group][name] = sum(shard.counts.get(name, 0)
+                                      for shard in group_shards[group]
+                                      if shard)
+        memcache.add_multi(dict((_memcache_key(group, name),
+                                 totals[group][name] + MEMCACHE_OFFSET)
+                                for group, name in missing))
+    return totals
+
+
+def drain(group, names, num_shards=DEFAULT_NUM_SHARDS):
+    """Zeroes counters of a group and returns their totals, so they can be
+    folded into another entity. Must be called inside a cross-group
+    transaction, which then includes every shard of the group; the cached
+    totals are dropped once it commits.
+    Args:
+        group: The name of the counter group
+        names: The counter names to drain
+        num_shards: The number of shards the group is spread over
+    Returns:
+        A dict mapping each counter name to the total that was drained.
+    """
+    totals = dict((name, 0) for name in names)
+    drained = []
+    for shard in ndb.get_multi(_shard_keys(group, num_shards)):
+        if not shard:
+            continue
+        counts = dict(shard.counts)
+        for name in names:
+            totals[name] += counts.pop(name, 0)
+        if counts != shard.counts:
+            shard.counts = counts
+            drained.append(shard)
+    ndb.put_multi(drained)
+    memcache_keys = [_memcache_key(group, name) for name in names]
+    ndb.get_context().call_on_commit(
+        lambda: utils.invalidate_memcache(*memcache_keys))
+    return totals
+
+
+def reconcile(group, totals, num_shards=DEFAULT_NUM_SHARDS):
+    """Corrects the counters of a group to totals computed from the source
+    data, e.g. by an occasional full scan.
+    Args:
+        group: The name of the counter group
+        totals: A dict mapping counter names to their true totals
+        num_shards: The number of shards the group is spread over
+    """
+    shards = ndb.get_multi(_shard_keys(group, num_shards))
+    deltas = {}
+    for name, total in totals.items():
+        current = sum(shard.counts.get(name, 0) for shard in shards if shard)
+        deltas[name] = total - current
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if deltas:
+        key = _shard_keys(group, num_shards)[random.randrange(num_shards)]
+        _increment_shard(key, deltas)
+    memcache.delete_multi([_memcache_key(group, name) for name in totals])
+
@@ -0,0 +1,185 @@
+"""dictionaries.py - Imports packed word lists into the datastore, so the
+dictionary can be replaced without a redeploy.
+
+An import streams a packed word list (built with build_dictionary.py) from a
+URL with HTTP range requests, one block per task, into DictionaryBlock
+entities. Once every block is stored and the whole list checks out, the
+CurrentDictionary pointer is switched to the new version. Instances notice
+the switch within CHECK_SECONDS and copy the new version's blocks, one at a
+time, into a single buffer; until a dictionary is imported, the deployed
+words.bin is used."""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+import utils
+import wordbank
+
+# Stays under the datastore's 1MB entity limit.
+BLOCK_SIZE = 900 * 1024
+FETCH_DEADLINE = 60
+CHECK_SECONDS = 60
+MEMCACHE_CURRENT = 'dictionary:current'
+IMPORT_URL = '/tasks/import_dictionary'
+
+
+class Dictionary(ndb.Model):
+    """An imported packed word list, keyed by its version"""
+    url = ndb.StringProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(indexed=False)
+    blocks = ndb.IntegerProperty(default=0, indexed=False)
+    word_count = ndb.IntegerProperty(indexed=False)
+    complete = ndb.BooleanProperty(default=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class DictionaryBlock(ndb.Model):
+    """One block of the bytes of an imported Dictionary, keyed by the
+    Dictionary's version and the block's index"""
+    data = ndb.BlobProperty(required=True)
+
+
+class CurrentDictionary(ndb.Model):
+    """Points to the version of the Dictionary that new games use"""
+    version = ndb.StringProperty(required=True, indexed=False)
+
+
+def _block_key(version, index):
+    return ndb.Key(DictionaryBlock, '{}:{}'.format(version, index))
+
+
+def _current_key():
+    return ndb.Key(CurrentDictionary, 'current')
+
+
+def start_import(url):
+    """Starts importing a packed word list from a URL.
+    Returns:
+        The version of the new Dictionary."""
+    version = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    Dictionary(id=version, url=url).put()
+    _add_import_task(version, 0)
+    return version
+
+
+def _add_import_task(version, index):
+    # Named after the block, so a retried task can't enqueue the next block
+    # twice.
+    utils.add_named_task(IMPORT_URL,
+                         'dictionary-{}-{}'.format(version, index),
+                         {'version': version, 'index': str(index)})
+
+
+def import_block(version, index):
+    """Fetches and stores one block of a Dictionary, then queues the next
+    block, or activates the Dictionary once it is complete.
+    Raises:
+        ValueError: If the URL does not serve a packed word list of the size
+            given in its header."""
+    dictionary = ndb.Key(Dictionary, version).get()
+    if not dictionary or dictionary.complete:
+        return
+    start = index * BLOCK_SIZE
+    response = urlfetch.fetch(
+        dictionary.url, deadline=FETCH_DEADLINE,
+        headers={'Range': 'bytes={}-{}'.format(start, start + BLOCK_SIZE - 1)})
+    if response.status_code == 200 and index == 0:
+        # The server ignored the range; keep the first block of the whole.
+        data = response.content[:BLOCK_SIZE]
+    elif response.status_code == 206:
+        data = response.content
+    else:
+        raise ValueError('Fetching {} failed with status {}'.format(
+            dictionary.url, response.status_code))
+
+    if index == 0:
+        # The later blocks' tasks need the size to know when to stop.
+        dictionary.size = wordbank.packed_size(data)
+        ndb.put_multi([dictionary,
+                       DictionaryBlock(key=_block_key(version, index),
+                                       data=data)])
+    elif dictionary.size is None:
+        raise ValueError('Dictionary {} has no size'.format(version))
+    else:
+        DictionaryBlock(key=_block_key(version, index), data=data).put()
+
+    if start + len(data) < dictionary.size:
+        _add_import_task(version, index + 1)
+        return
+    dictionary.blocks = index + 1
+    # Loading checks the whole list before any instance uses it.
+    dictionary.word_count = len(_load(dictionary))
+    dictionary.complete = True
+    dictionary.put()
+    _activate(version)
+    logging.info('Imported dictionary %s: %s words', version,
+                 dictionary.word_count)
+
+
+def _activate(version):
+    CurrentDictionary(key=_current_key(), version=version).put()
+    memcache.set(MEMCACHE_CURRENT, version)
+
+
+def _load(dictionary):
+    # Copy one block at a time into a buffer of the final size, so only one
+    # block is held besides the buffer. The blocks are kept out of the
+    # context cache for the same reason.
+    buffer = bytearray(dictionary.size)
+    position = 0
+    for index in range(dictionary.blocks):
+        block = _block_key(dictionary.key.id(), index).get(
+            use_cache=False, use_memcache=False)
+        if not block:
+            raise ValueError('Dictionary {} is missing blocks'.format(
+                dictionary.key.id()))
+        data = block.data[:dictionary.size - position]
+        buffer[position:position + len(data)] = data
+        position += len(data)
+        block = data = None
+    return wordbank.WordBank(buffer)
+
+
+def get_current_version():
+    """Returns the version of the current Dictionary, or None if no
+    dictionary has been imported"""
+    version = memcache.get(MEMCACHE_CURRENT)
+    if version is None:
+        current = _current_key().get()
+        version = current.version if current else ''
+        memcache.add(MEMCACHE_CURRENT, version)
+    return version or None
+
+
+_lock = threading.Lock()
+_loaded = {'version': None, 'word_bank': None, 'checked': 0}
+
+
+def get_word_bank():
+    """Returns the WordBank of the current Dictionary, or of the deployed
+    words.bin if none has been imported. The current version is checked at
+    most every CHECK_SECONDS per instance."""
+    if time.time() - _loaded['checked'] < CHECK_SECONDS:
+        return _loaded['word_bank'] or wordbank.get_word_bank()
+    with _lock:
+        if time.time() - _loaded['checked'] >= CHECK_SECONDS:
+            version = get_current_version()
+            if version != _loaded['version']:
+                word_bank = None
+                if version:
+                    word_bank = _load(ndb.Key(Dictionary, version).get())
+                _loaded['version'] = version
+                _loaded['word_bank'] = word_bank
+            _loaded['checked'] = time.time()
+    return _loaded['word_bank'] or wordbank.get_word_bank()
+
+
+def choose_word(word_length=None, difficulty=None):
+    """Returns a random word from the current dictionary"""
+    return get_word_bank().choose(word_length, difficulty)
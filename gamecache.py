@@ -0,0 +1,92 @@
+"""gamecache.py - Read-through/write-through memcache cache of live Game
+state, keyed by urlsafe game key.
+
+Each entry holds the Game together with its owner's name, so a cache hit
+serves a GameForm without any datastore reads. Writers update entries with
+compare-and-set and never replace an entry with an older version of the
+game."""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import utils
+
+MEMCACHE_GAME = 'game:{}'
+GAME_EXPIRY = 60 * 60
+CAS_RETRIES = 3
+
+
+def _memcache_key(game_key):
+    return MEMCACHE_GAME.format(game_key.urlsafe())
+
+
+def _version(game):
+    """Orders the states of a game; every put of a game increases it"""
+    return game.version or 0
+
+
+@ndb.tasklet
+def get_async(game_key):
+    """Reads a game through the cache.
+    Args:
+        game_key: The ndb.Key of the Game
+    Returns:
+        A Future for a (game, user_name) tuple, or (None, None) if the game
+        does not exist.
+    """
+    context = ndb.get_context()
+    memcache_key = _memcache_key(game_key)
+    entry = yield context.memcache_get(memcache_key)
+    if entry:
+        raise ndb.Return((entry['game'], entry['user_name']))
+
+    game = yield game_key.get_async()
+    if not game:
+        raise ndb.Return((None, None))
+    user = yield game.user.get_async()
+    # add rather than set, so a write that landed meanwhile is kept.
+    yield context.memcache_add(memcache_key,
+                               {'game': game, 'user_name': user.name},
+                               time=GAME_EXPIRY)
+    raise ndb.Return((game, user.name))
+
+
+def get(game_key):
+    """Synchronous version of get_async"""
+    return get_async(game_key).get_result()
+
+
+def update(game, user_name=None):
+    """Writes a game's new state through to the cache. Call this once the
+    game has been put.
+    Args:
+        game: The Game that was put
+        user_name: The owner's name, if known. Without it a missing entry is
+            left to be filled by the next read.
+    """
+    client = memcache.Client()
+    memcache_key = _memcache_key(game.key)
+    for _ in range(CAS_RETRIES):
+        entry = client.gets(memcache_key)
+        if entry is None:
+            if user_name is None:
+                invalidate(game.key)
+                return
+            if client.add(memcache_key,
+                          {'game': game, 'user_name': user_name},
+                          time=GAME_EXPIRY):
+                return
+        elif _version(entry['game']) > _version(game):
+            # A later state has already been written.
+            return
+        elif client.cas(memcache_key,
+                        {'game': game, 'user_name': entry['user_name']},
+                        time=GAME_EXPIRY):
+            return
+    invalidate(game.key)
+
+
+def invalidate(game_key):
+    """Drops a game from the cache and briefly blocks readers from adding it
+    back, so they can't cache a state read before the latest write"""
+    utils.invalidate_memcache(_memcache_key(game_key))
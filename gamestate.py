@@ -0,0 +1,75 @@
+"""gamestate.py - Compact Hangman game state.
+
+The target word's letters and the guessed letters are each held as a 26 bit
+mask, one bit per letter of the alphabet, so checking a guess, spotting a
+repeated guess and detecting a win are single bit operations."""
+
+import string
+
+LETTERS = string.ascii_lowercase
+
+
+def letter_bit(letter):
+    """Returns the mask bit of a lower case letter"""
+    return 1 << (ord(letter) - ord('a'))
+
+
+def letters_mask(letters):
+    """Returns the mask of every letter in a string"""
+    mask = 0
+    for letter in letters.lower():
+        if letter in LETTERS:
+            mask |= letter_bit(letter)
+    return mask
+
+
+class GameState(object):
+    """The target word of a game and the letters guessed so far"""
+    __slots__ = ('target', 'target_mask', 'guessed_mask')
+
+    def __init__(self, target, guessed_mask=0, target_mask=None):
+        self.target = target
+        self.target_mask = (letters_mask(target) if target_mask is None
+                            else target_mask)
+        self.guessed_mask = guessed_mask
+
+    def is_valid_guess(self, guess):
+        """Returns True if guess is a single letter that hasn't been guessed"""
+        if len(guess) != 1 or not guess.isalpha():
+            return False
+        guess = guess.lower()
+        return guess in LETTERS and not self.guessed_mask & letter_bit(guess)
+
+    def contains(self, letter):
+        """Returns True if the letter is in the target word"""
+        return bool(self.target_mask & letter_bit(letter.lower()))
+
+    def guess(self, letter):
+        """Records a letter guess. Returns True if the letter is in the target
+        word."""
+        bit = letter_bit(letter.lower())
+        self.guessed_mask |= bit
+        return bool(self.target_mask & bit)
+
+    def is_solved(self):
+        """Returns True once every letter of the target word is guessed"""
+        return not self.target_mask & ~self.guessed_mask
+
+    def pattern(self):
+        """Returns the target word with unguessed letters as '_' and no
+        spaces, e.g. 'h_ng_an'"""
+        guessed_mask = self.guessed_mask
+        return ''.join([letter if guessed_mask & letter_bit(letter) else '_'
+                        for letter in self.target])
+
+    def wrong_letters(self):
+        """Returns the guessed letters that are not in the target word"""
+        wrong_mask = self.guessed_mask & ~self.target_mask
+        return ''.join([letter for letter in LETTERS
+                        if wrong_mask & letter_bit(letter)])
+
+    def progress(self):
+        """Returns the target word with unguessed letters shown as '_'"""
+        guessed_mask = self.guessed_mask
+        return ''.join([letter + ' ' if guessed_mask & letter_bit(letter)
+                        else '_ ' for letter in self.target])
@@ -0,0 +1,107 @@
+"""highscores.py - The best winning scores, kept as a bounded top K list.
+
+The list lives in a single HighScores entity and is cached in memcache, so
+get_highscores is one memcache get. When a game is won the score is checked
+against the cached list and, only if it would make the list, a transactional
+task inserts it. Most wins don't qualify once the list is full, so ending a
+game usually costs one memcache get here."""
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import utils
+
+SIZE = 100
+MEMCACHE_HIGHSCORES = 'highscores'
+HIGHSCORES_EXPIRY = 60 * 60
+UPDATE_URL = '/tasks/update_highscores'
+
+
+class HighScores(ndb.Model):
+    """The best winning scores, fewest guesses first. Each entry is a dict
+    of id, user_name, date (ISO format) and guesses, where id is the urlsafe
+    key of the won Game, or of the Score for entries built by rebuild."""
+    entries = ndb.JsonProperty(default=[])
+
+
+def _key():
+    return ndb.Key(HighScores, 'top')
+
+
+def _sort_key(entry):
+    # Ties go to the earlier score.
+    return entry['guesses'], entry['date']
+
+
+@ndb.tasklet
+def get_async():
+    """Returns a Future for the list of high score entries, best first"""
+    context = ndb.get_context()
+    entries = yield context.memcache_get(MEMCACHE_HIGHSCORES)
+    if entries is None:
+        high_scores = yield _key().get_async()
+        entries = high_scores.entries if high_scores else []
+        yield context.memcache_add(MEMCACHE_HIGHSCORES, entries,
+                                   time=HIGHSCORES_EXPIRY)
+    raise ndb.Return(entries)
+
+
+def _qualifies(entries, entry):
+    return len(entries) < SIZE or _sort_key(entry) < _sort_key(entries[-1])
+
+
+@ndb.tasklet
+def add_async(game, score, user_name):
+    """Queues a winning score to be inserted in the high scores if it would
+    make the list. Inside a transaction the task is only added if the
+    transaction commits.
+    Args:
+        game: The won Game
+        score: The game's new Score
+        user_name: The name of the game's User
+    """
+    entry = {'id': game.key.urlsafe(), 'user_name': user_name,
+             'date': score.date.isoformat(), 'guesses': score.guesses}
+    entries = yield ndb.get_context().memcache_get(MEMCACHE_HIGHSCORES)
+    # Without a cached list the task does the check.
+    if entries is not None and not _qualifies(entries, entry):
+        return
+    yield taskqueue.add_async(url=UPDATE_URL, params=entry,
+                              transactional=ndb.in_transaction())
+
+
+@ndb.transactional
+def _insert(entry):
+    high_scores = _key().get() or HighScores(key=_key())
+    entries = high_scores.entries
+    # A task can run more than once.
+    if any(current['id'] == entry['id'] for current in entries):
+        return False
+    if not _qualifies(entries, entry):
+        return False
+    entries = sorted(entries + [entry], key=_sort_key)[:SIZE]
+    high_scores.entries = entries
+    high_scores.put()
+    return True
+
+
+def insert(entry):
+    """Inserts an entry in the high scores if it makes the list. Called by
+    the task queued by add_async."""
+    if _insert(entry):
+        utils.invalidate_memcache(MEMCACHE_HIGHSCORES)
+
+
+def rebuild(scores, user_names):
+    """Replaces the high scores with the best of a list of winning Scores,
+    e.g. to build the list from the Scores recorded before it existed.
+    Args:
+        scores: Winning Scores, each with its key
+        user_names: A dict mapping User keys to names
+    """
+    entries = [{'id': score.key.urlsafe(),
+                'user_name': user_names.get(score.user, ''),
+                'date': score.date.isoformat(), 'guesses': score.guesses}
+               for score in scores]
+    HighScores(key=_key(), entries=sorted(entries, key=_sort_key)[:SIZE]).put()
+    utils.invalidate_memcache(MEMCACHE_HIGHSCORES)
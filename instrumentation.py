@@ -0,0 +1,212 @@
+"""instrumentation.py - Per-request RPC and latency accounting.
+
+An apiproxy hook counts the datastore and memcache RPCs made while a request
+is being handled, and times them. The WSGI middleware wraps the endpoints API
+server and the webapp2 task/cron application, writes one structured log line
+per request and adds the request's numbers to per-route totals kept in
+memcache, which the admin stats handler reads.
+
+Startup steps, such as importing the API and warming up an instance, are
+timed too. Their timings are added to per-step totals along with the next
+request's numbers, so cold-start regressions show up in the admin stats.
+
+The hooks only touch a thread local object and the middleware makes one
+memcache RPC per request, so they are cheap enough to leave on."""
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_PREFIX = 'instrumentation:'
+STARTUP_PREFIX = 'startup:'
+API_PATH_PREFIX = '/_ah/spi/'
+
+# Totals kept per route; the *_ms values are summed milliseconds.
+METRICS = ('requests', 'datastore_gets', 'datastore_puts', 'datastore_queries',
+           'datastore_other', 'entities_read', 'entities_written',
+           'memcache_hits', 'memcache_misses', 'memcache_other',
+           'datastore_ms', 'memcache_ms', 'total_ms')
+
+# Timed startup steps: importing each script's module, and each step of an
+# instance warmup.
+STARTUP_STEPS = ('main', 'api', 'warmup', 'warmup.word_bank',
+                 'warmup.solver', 'warmup.api')
+STARTUP_METRICS = ('count', 'total_ms')
+
+_local = threading.local()
+_startup_lock = threading.Lock()
+_pending_startup = {}
+
+
+class RequestStats(object):
+    """The RPCs made while handling one request"""
+    __slots__ = METRICS + ('route', '_started', '_rpc_started')
+
+    def __init__(self, route):
+        for metric in METRICS:
+            setattr(self, metric, 0)
+        self.requests = 1
+        self.route = route
+        self._started = time.time()
+        self._rpc_started = {}
+
+    def to_dict(self):
+        return dict((metric, getattr(self, metric)) for metric in METRICS)
+
+
+def _pre_call_hook(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats._rpc_started[id(request)] = time.time()
+
+
+def _post_call_hook(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return
+    started = stats._rpc_started.pop(id(request), None)
+    elapsed_ms = (time.time() - started) * 1000 if started else 0
+
+    if service == 'datastore_v3':
+        stats.datastore_ms += elapsed_ms
+        if call == 'Get':
+            stats.datastore_gets += 1
+            stats.entities_read += sum(1 for entity in response.entity_list()
+                                       if entity.has_entity())
+        elif call == 'Put':
+            stats.datastore_puts += 1
+            stats.entities_written += request.entity_size()
+        elif call in ('RunQuery', 'Next'):
+            stats.datastore_queries += 1
+            stats.entities_read += response.result_size()
+        elif call == 'Delete':
+            stats.datastore_other += 1
+            stats.entities_written += request.key_size()
+        else:
+            stats.datastore_other += 1
+    elif service == 'memcache':
+        stats.memcache_ms += elapsed_ms
+        if call == 'Get':
+            hits = response.item_size()
+            stats.memcache_hits += hits
+            stats.memcache_misses += request.key_size() - hits
+        else:
+            stats.memcache_other += 1
+
+
+def install():
+    """Registers the RPC hooks. Safe to call more than once."""
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('instrumentation', _pre_call_hook)
+    apiproxy.GetPostCallHooks().Append('instrumentation', _post_call_hook)
+
+
+def start_request(route):
+    """Starts accounting the RPCs of the current thread to a route"""
+    _local.stats = RequestStats(route)
+    return _local.stats
+
+
+def finish_request():
+    """Stops accounting the current request. Returns its RequestStats."""
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    if stats is not None:
+        stats.total_ms = (time.time() - stats._started) * 1000
+    return stats
+
+
+def record_startup(step, started):
+    """Records how long a startup step took. The timing is logged now and
+    added to the step's totals when the next request is published, so it
+    costs no RPC of its own.
+    Args:
+        step: One of STARTUP_STEPS
+        started: The time.time() at which the step started
+    """
+    elapsed_ms = (time.time() - started) * 1000
+    logging.info('startup_timing %s',
+                 json.dumps({'step': step, 'ms': elapsed_ms}, sort_keys=True))
+    key_prefix = '{}{}:'.format(STARTUP_PREFIX, step)
+    with _startup_lock:
+        for metric, value in (('count', 1), ('total_ms', elapsed_ms)):
+            _pending_startup[key_prefix + metric] = (
+                _pending_startup.get(key_prefix + metric, 0) + value)
+
+
+def publish(stats):
+    """Logs a request's stats and adds them, and any startup timings
+    recorded since the last request, to the totals"""
+    values = stats.to_dict()
+    logging.info('request_stats %s',
+                 json.dumps(dict(values, route=stats.route), sort_keys=True))
+    offsets = dict(('{}:{}'.format(stats.route, metric), value)
+                   for metric, value in values.items())
+    with _startup_lock:
+        offsets.update(_pending_startup)
+        _pending_startup.clear()
+    memcache.offset_multi(
+        dict((key, int(round(value))) for key, value in offsets.items()
+             if value),
+        key_prefix=MEMCACHE_PREFIX,
+        initial_value=0)
+
+
+def get_totals(routes):
+    """Returns a dict mapping each route to a dict of its totals"""
+    keys = ['{}:{}'.format(route, metric)
+            for route in routes for metric in METRICS]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_PREFIX)
+    totals = {}
+    for route in routes:
+        route_totals = dict((metric,
+                             values.get('{}:{}'.format(route, metric), 0))
+                            for metric in METRICS)
+        if route_totals['requests']:
+            totals[route] = route_totals
+    return totals
+
+
+def get_startup_totals():
+    """Returns a dict mapping each timed startup step to its count, total_ms
+    and average_ms"""
+    keys = ['{}{}:{}'.format(STARTUP_PREFIX, step, metric)
+            for step in STARTUP_STEPS for metric in STARTUP_METRICS]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_PREFIX)
+    totals = {}
+    for step in STARTUP_STEPS:
+        count, total_ms = [
+            values.get('{}{}:{}'.format(STARTUP_PREFIX, step, metric), 0)
+            for metric in STARTUP_METRICS]
+        if count:
+            totals[step] = {'count': count, 'total_ms': total_ms,
+                            'average_ms': float(total_ms) / count}
+    return totals
+
+
+def route_for_path(path):
+    """Returns the route a request path is accounted to"""
+    if path.startswith(API_PATH_PREFIX):
+        return path[len(API_PATH_PREFIX):]
+    return path
+
+
+def middleware(app):
+    """Wraps a WSGI application so every request it handles is accounted"""
+    install()
+
+    def instrumented_app(environ, start_response):
+        start_request(route_for_path(environ.get('PATH_INFO', '')))
+        try:
+            return app(environ, start_response)
+        finally:
+            stats = finish_request()
+            try:
+                publish(stats)
+            except Exception:
+                logging.exception('Could not publish request stats')
+    return instrumented_app
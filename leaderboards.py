@@ -0,0 +1,267 @@
+"""leaderboards.py - Daily and weekly leaderboards.
+
+Each day and each ISO week is a window, and every user who finishes a game
+in a window has a WindowScore entity holding their wins and losses in it.
+Ending a game adds to the WindowScores of its day and week once its
+transaction commits, and queues a refresh of their leaderboards at most once
+every REFRESH_SECONDS. A refresh ranks the window's WindowScores with an
+indexed query and stores the top LEADERBOARD_SIZE in a WindowLeaderboard
+entity, cached in memcache, so reading a window's leaderboard is a single
+read. Once a window has closed, the compaction cron stores its final
+leaderboard and deletes its WindowScores."""
+
+import time
+from datetime import timedelta
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import utils
+
+DAY = 'day'
+WEEK = 'week'
+WINDOWS = (DAY, WEEK)
+
+LEADERBOARD_SIZE = 100
+REFRESH_SECONDS = 60
+DELETE_BATCH_SIZE = 500
+MEMCACHE_WINDOW = 'window_leaderboard:{}'
+WINDOW_EXPIRY = 60 * 60
+REFRESH_URL = '/tasks/refresh_window_leaderboard'
+
+
+class WindowLeaderboard(ndb.Model):
+    """The top users of a day or week, keyed by window id. Each entry is a
+    [user_name, rank, wins, losses] list, highest rank first."""
+    window = ndb.StringProperty(required=True)
+    end = ndb.DateProperty(required=True)
+    entries = ndb.JsonProperty(default=[])
+    compacted = ndb.BooleanProperty(default=False)
+
+
+class WindowScore(ndb.Model):
+    """A User's wins and losses in one window, keyed by the window id and
+    the User's key"""
+    window_id = ndb.StringProperty(required=True)
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    wins = ndb.IntegerProperty(default=0)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+    rank = ndb.ComputedProperty(lambda self: self.wins - self.losses)
+    # The cutoff of the backfill whose games have been added, if any.
+    backfilled = ndb.DateProperty(indexed=False)
+
+
+def window_id(window, day):
+    """Returns the id of the day or ISO week window containing a date, e.g.
+    'day:2016-05-01' or 'week:2016-W17'"""
+    if window == DAY:
+        return 'day:{}'.format(day.isoformat())
+    year, week, _ = day.isocalendar()
+    return 'week:{}-W{:02d}'.format(year, week)
+
+
+def window_end(window, day):
+    """Returns the last date of the window containing a date"""
+    if window == DAY:
+        return day
+    return day + timedelta(days=7 - day.isoweekday())
+
+
+def _get_or_new_score(window, user_key):
+    key = ndb.Key(WindowScore, '{}:{}'.format(window, user_key.urlsafe()))
+    return key.get() or WindowScore(key=key, window_id=window, user=user_key)
+
+
+def record_game(user_key, won, day):
+    """Adds a finished game to the leaderboards of its day and week. Inside
+    a transaction the WindowScores are updated and the refreshes queued once
+    it commits.
+    Args:
+        user_key: The key of the game's User
+        won: Whether the User won
+        day: The date of the game's Score
+    """
+    for window in WINDOWS:
+        utils.after_commit(_add_game, window_id(window, day), user_key, won)
+        utils.after_commit(_add_refresh_task, window, day)
+
+
+@ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
+def _add_game(window, user_key, won):
+    score = _get_or_new_score(window, user_key)
+    if won:
+        score.wins += 1
+    else:
+        score.losses += 1
+    score.put()
+
+
+def _add_refresh_task(window, day):
+    # Named after the window and the current REFRESH_SECONDS period, so the
+    # games a window gets within a period share a single refresh.
+    period = int(time.time()) // REFRESH_SECONDS
+    utils.add_named_task(REFRESH_URL,
+                         'window-refresh-{}-{}'.format(
+                             window_id(window, day).replace(':', '-'), period),
+                         {'window': window, 'date': day.isoformat()},
+                         countdown=REFRESH_SECONDS)
+
+
+def move_scores(old_user_key, new_user_key, day):
+    """Adds a User's WindowScores in the windows that may still be open on a
+    date, which are the date's and the day before's day and week, to the
+    WindowScores of the User's new key, deletes them, and queues refreshes
+    of their leaderboards once the transaction commits. Must be called
+    inside a cross-group transaction.
+    Args:
+        old_user_key: The User's old key
+        new_user_key: The User's new key
+        day: Today's date
+    """
+    moved = set()
+    for window in WINDOWS:
+        for open_day in (day - timedelta(days=1), day):
+            window_key = window_id(window, open_day)
+            if window_key in moved:
+                continue
+            old_score = ndb.Key(WindowScore, '{}:{}'.format(
+                window_key, old_user_key.urlsafe())).get()
+            if not old_score:
+                continue
+            moved.add(window_key)
+            score = _get_or_new_score(window_key, new_user_key)
+            score.wins += old_score.wins
+            score.losses += old_score.losses
+            # The backfill cutoff is the same for every User, if set.
+            score.backfilled = score.backfilled or old_score.backfilled
+            score.put()
+            old_score.key.delete()
+            utils.after_commit(_add_refresh_task, window, open_day)
+
+
+def _entries(ranked):
+    """Returns the leaderboard entries of (user_key, wins, losses) tuples,
+    highest rank first"""
+    users = ndb.get_multi([user_key for user_key, _, _ in ranked])
+    return [[user.name, wins - losses, wins, losses]
+            for user, (_, wins, losses) in zip(users, ranked) if user]
+
+
+def _rank(window, day):
+    """Returns the leaderboard entries of a window's WindowScores"""
+    scores = WindowScore.query(
+        WindowScore.window_id == window_id(window, day)).order(
+            -WindowScore.rank, -WindowScore.wins).fetch(LEADERBOARD_SIZE)
+    return _entries([(score.user, score.wins, score.losses)
+                     for score in scores])
+
+
+def _totals(scores):
+    """Returns a dict mapping each User's key to their [wins, losses] in an
+    iterable of Scores"""
+    totals = {}
+    for score in scores:
+        totals.setdefault(score.user, [0, 0])[0 if score.won else 1] += 1
+    return totals
+
+
+def _store(leaderboard, entries):
+    leaderboard.entries = entries
+    leaderboard.put()
+    memcache.set(MEMCACHE_WINDOW.format(leaderboard.key.id()), entries,
+                 time=WINDOW_EXPIRY)
+
+
+def _delete_scores(window):
+    keys = []
+    query = WindowScore.query(WindowScore.window_id == window)
+    for key in query.iter(keys_only=True, batch_size=DELETE_BATCH_SIZE):
+        keys.append(key)
+        if len(keys) == DELETE_BATCH_SIZE:
+            ndb.delete_multi(keys)
+            keys = []
+    ndb.delete_multi(keys)
+
+
+def refresh(window, day):
+    """Re-ranks the leaderboard of a window from its WindowScores. A
+    compacted window has no WindowScores left, so it is left as it is."""
+    key = ndb.Key(WindowLeaderboard, window_id(window, day))
+    leaderboard = key.get()
+    if leaderboard and leaderboard.compacted:
+        return
+    leaderboard = WindowLeaderboard(key=key, window=window,
+                                    end=window_end(window, day))
+    _store(leaderboard, _rank(window, day))
+
+
+@ndb.tasklet
+def get_async(window, day):
+    """Returns a Future for the leaderboard entries of the window containing
+    a date, highest rank first"""
+    context = ndb.get_context()
+    memcache_key = MEMCACHE_WINDOW.format(window_id(window, day))
+    entries = yield context.memcache_get(memcache_key)
+    if entries is None:
+        leaderboard = yield ndb.Key(WindowLeaderboard,
+                                    window_id(window, day)).get_async()
+        entries = leaderboard.entries if leaderboard else []
+        yield context.memcache_add(memcache_key, entries, time=WINDOW_EXPIRY)
+    raise ndb.Return(entries)
+
+
+def compact(today):
+    """Stores the final leaderboard of every window that ended before a date
+    and deletes its WindowScores"""
+    query = WindowLeaderboard.query(WindowLeaderboard.compacted == False,
+                                    WindowLeaderboard.end < today)
+    for leaderboard in query:
+        leaderboard.compacted = True
+        _store(leaderboard, _rank(leaderboard.window, leaderboard.end))
+        _delete_scores(leaderboard.key.id())
+
+
+def backfill_closed(window, day, scores):
+    """Stores the final leaderboard of a window that has ended from every
+    Score in it, and deletes any WindowScores left for it. Safe to repeat,
+    since nothing is added to.
+    Args:
+        window: DAY or WEEK
+        day: A date in the window
+        scores: An iterable of every Score of the window, e.g. a query
+    """
+    ranked = sorted(((user_key, wins, losses) for user_key, (wins, losses)
+                     in _totals(scores).items()),
+                    key=lambda item: (item[2] - item[1], -item[1]))
+    leaderboard = WindowLeaderboard(
+        key=ndb.Key(WindowLeaderboard, window_id(window, day)),
+        window=window, end=window_end(window, day), compacted=True)
+    _store(leaderboard, _entries(ranked[:LEADERBOARD_SIZE]))
+    _delete_scores(window_id(window, day))
+
+
+def backfill_open(window, day, until, scores):
+    """Adds the Scores of a window that is still open from before the games
+    were recorded live to its WindowScores, and re-ranks it. Each User's
+    WindowScore is marked with the cutoff, so a retried task doesn't add
+    their games twice.
+    Args:
+        window: DAY or WEEK
+        day: A date in the window
+        until: The date games started being recorded live
+        scores: An iterable of the window's Scores dated before until
+    """
+    for user_key, (wins, losses) in _totals(scores).items():
+        _add_backfilled(window_id(window, day), user_key, wins, losses, until)
+    refresh(window, day)
+
+
+@ndb.transactional
+def _add_backfilled(window, user_key, wins, losses, until):
+    score = _get_or_new_score(window, user_key)
+    if score.backfilled == until:
+        return
+    score.wins += wins
+    score.losses += losses
+    score.backfilled = until
+    score.put()
@@ -2,40 +2,539 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import time
+_IMPORT_STARTED = time.time()
+
+import hashlib
+import json
 import logging
+from datetime import date, datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import HangmanApi
+from google.appengine.api import app_identity
+from google.appengine.api import apiproxy_stub_map, api_base_pb
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+import dictionaries
+import highscores
+import leaderboards
+import instrumentation
+import solver
+import utils
+
+from models import User, UserStats, Game, Score, Move, ReminderLog,\
+    Migration, USER_KEYS_MIGRATION, USER_COUNTERS
 
-from models import User
+REMINDER_CHUNK_SIZE = 50
+REMINDER_LOG_EXPIRY = timedelta(days=1)
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        """Starts a reminder run, which emails each User with an email about
+        their active games. Called every hour using a cron job. The Users are
+        processed by a chain of SendReminderChunk tasks."""
+        run_id = datetime.utcnow().strftime('%Y%m%d%H')
+        _add_reminder_chunk(run_id, 0, None)
+
+        cutoff = datetime.utcnow() - REMINDER_LOG_EXPIRY
+        ndb.delete_multi(ReminderLog.query(ReminderLog.created < cutoff)
+                         .fetch(keys_only=True))
+
+
+class SendReminderChunk(webapp2.RequestHandler):
+    def post(self):
+        """Emails one chunk of the Users with active games, after enqueuing
+        the task for the next chunk. The mails of a chunk are sent in
+        parallel, and the Users that were reminded are recorded so a retried
+        task doesn't remind them twice."""
+        run_id = self.request.get('run_id')
+        index = int(self.request.get('index'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query(User.active_games > 0).fetch_page(
+            REMINDER_CHUNK_SIZE, start_cursor=cursor)
+        if more and next_cursor:
+            _add_reminder_chunk(run_id, index + 1, next_cursor.urlsafe())
+
+        # The query matches the active games as of each User's last rollup;
+        # skip Users whose games have all ended since.
+        totals = User.get_counter_totals(users)
+        users = [user for user in users
+                 if totals[user.key]['active_games'] > 0]
+
+        log_key = ndb.Key(ReminderLog, '{}:{}'.format(run_id, index))
+        log = log_key.get() or ReminderLog(key=log_key)
+        already_sent = set(log.sent)
+
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None, User.active_games > 0)
+        rpcs = []
         for user in users:
-            subject = 'This is a reminder!'
-            body = 'Hello {}, take your move in Hangman!'.format(user.name)
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+            if user.email and user.key not in already_sent:
+                rpcs.append((user.key, _send_reminder_async(app_id, user)))
+
+        failed = 0
+        for user_key, rpc in rpcs:
+            try:
+                rpc.check_success()
+                log.sent.append(user_key)
+            except Exception:
+                logging.exception('Reminder to %s failed', user_key.id())
+                failed += 1
+        if rpcs:
+            log.put()
+        # Fail the task so it is retried; the log skips the Users already
+        # reminded.
+        self.response.set_status(500 if failed else 204)
+
+
+def _add_reminder_chunk(run_id, index, cursor):
+    """Enqueues the task for one chunk of a reminder run. The task is named
+    after the run and chunk, so a retried cron or task can't enqueue it
+    twice."""
+    params = {'run_id': run_id, 'index': str(index)}
+    if cursor:
+        params['cursor'] = cursor
+    utils.add_named_task('/tasks/send_reminder_chunk',
+                         'reminder-{}-{}'.format(run_id, index), params)
+
+
+def _send_reminder_async(app_id, user):
+    """Starts sending a reminder to a User. Returns the mail RPC."""
+    # This will send test emails, the arguments are: from, to, subject, body
+    # Only reminder chunks send mail, so the mail API is imported lazily.
+    from google.appengine.api import mail
+    message = mail.EmailMessage(
+        sender='noreply@{}.appspotmail.com'.format(app_id),
+        to=user.email,
+        subject='This is a reminder!',
+        body='Hello {}, take your move in Hangman!'.format(user.name))
+    # The mail API has no asynchronous call, so make the RPC that
+    # EmailMessage.send makes, without waiting for it.
+    rpc = apiproxy_stub_map.UserRPC('mail')
+    rpc.make_call('Send', message.ToProto(), api_base_pb.VoidProto())
+    return rpc
+
+
+class ReconcileAverageAttempts(webapp2.RequestHandler):
+    def get(self):
+        """Repair any drift in the active games counters behind the average
+        attempts remaining statistic. Called every day using a cron job"""
+        # The endpoints service is only imported by the handlers that need it.
+        from api import HangmanApi
+        HangmanApi._reconcile_average_attempts()
+        self.response.set_status(204)
+
+
+class UpdateHighScores(webapp2.RequestHandler):
+    def post(self):
+        """Inserts a winning score in the high scores if it makes the list.
+        Queued when a game is won."""
+        highscores.insert({'id': self.request.get('id'),
+                           'user_name': self.request.get('user_name'),
+                           'date': self.request.get('date'),
+                           'guesses': int(self.request.get('guesses'))})
+        self.response.set_status(204)
+
+
+class RebuildHighScores(webapp2.RequestHandler):
+    def post(self):
+        """Rebuilds the high scores from the best winning Scores. Only needed
+        once for Scores recorded before the high scores list existed."""
+        scores = Score.query(Score.won == True).order(Score.guesses).fetch(
+            highscores.SIZE)
+        highscores.rebuild(scores, utils.get_user_names(scores))
+        self.response.set_status(204)
+
+
+class ImportDictionary(webapp2.RequestHandler):
+    def post(self):
+        """Given a url, starts importing the packed word list it serves.
+        Otherwise imports the given block of an import in progress, as queued
+        by the previous block."""
+        url = self.request.get('url')
+        if url:
+            version = dictionaries.start_import(url)
+            self.response.write(version)
+            return
+        try:
+            dictionaries.import_block(self.request.get('version'),
+                                      int(self.request.get('index')))
+        except ValueError:
+            # Retrying won't help; the current dictionary stays in use.
+            logging.exception('Dictionary import failed')
+        self.response.set_status(204)
+
+
+class RollupUserCounters(webapp2.RequestHandler):
+    def post(self):
+        """Folds a User's win, loss and active game counters into the User.
+        Queued when a game starts or ends, at most once a minute per User."""
+        User.rollup_counters(ndb.Key(urlsafe=self.request.get('user_key')))
+        self.response.set_status(204)
+
+
+class RecordUserStats(webapp2.RequestHandler):
+    def post(self):
+        """Adds a finished game to its User's UserStats. Queued by the
+        transaction that ends the game."""
+        score = Score(user=ndb.Key(urlsafe=self.request.get('user_key')),
+                      date=_parse_date(self.request.get('date')),
+                      won=bool(self.request.get('won')),
+                      guesses=int(self.request.get('guesses')))
+        UserStats.record_finished_game(
+            ndb.Key(urlsafe=self.request.get('game_key')), score)
+        self.response.set_status(204)
+
+
+class RefreshWindowLeaderboard(webapp2.RequestHandler):
+    def post(self):
+        """Re-ranks a daily or weekly leaderboard from its WindowScores.
+        Queued when a game in the window ends, at most once a minute per
+        window."""
+        leaderboards.refresh(self.request.get('window'),
+                             _parse_date(self.request.get('date')))
+        self.response.set_status(204)
+
+
+class CompactWindowLeaderboards(webapp2.RequestHandler):
+    def get(self):
+        """Stores the final leaderboards of the days and weeks that have
+        ended and deletes their WindowScores. Called every day using a cron
+        job."""
+        leaderboards.compact(date.today())
+        self.response.set_status(204)
+
+
+class BackfillWindowLeaderboards(webapp2.RequestHandler):
+    def post(self):
+        """Builds the daily and weekly leaderboards of one day from its
+        Scores, then enqueues the next day. Starts from the earliest Score
+        when no date is given. Only the days before until are backfilled:
+        until is required and must be the date the windowed leaderboards
+        started recording games, since the games from then on are already
+        counted. Only needed once for Scores recorded before the windowed
+        leaderboards existed."""
+        if not self.request.get('until'):
+            self.response.set_status(400)
+            self.response.write('until, the date games started being '
+                                'recorded live, is required')
+            return
+        today = date.today()
+        until = min(_parse_date(self.request.get('until')), today)
+        if self.request.get('date'):
+            day = _parse_date(self.request.get('date'))
+        else:
+            first = Score.query().order(Score.date).get()
+            day = first.date if first else until
+        if day >= until:
+            self.response.set_status(204)
+            return
+
+        # Every day before until has ended, so its Scores are all recorded.
+        leaderboards.backfill_closed(
+            leaderboards.DAY, day,
+            Score.query(Score.date == day).iter(batch_size=500))
+        next_day = day + timedelta(days=1)
+        if day.isoweekday() == 7 or next_day == until:
+            start = day - timedelta(days=day.isoweekday() - 1)
+            end = leaderboards.window_end(leaderboards.WEEK, day)
+            if end < today:
+                leaderboards.backfill_closed(
+                    leaderboards.WEEK, day,
+                    Score.query(Score.date >= start,
+                                Score.date <= end).iter(batch_size=500))
+            else:
+                # The current week's games from until on are already
+                # counted live.
+                leaderboards.backfill_open(
+                    leaderboards.WEEK, day, until,
+                    Score.query(Score.date >= start,
+                                Score.date < until).iter(batch_size=500))
+        if next_day < until:
+            utils.add_named_task('/tasks/backfill_window_leaderboards',
+                                 'window-backfill-{}-{}'.format(until,
+                                                                next_day),
+                                 {'date': next_day.isoformat(),
+                                  'until': until.isoformat()})
+        self.response.set_status(204)
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
 
+class BatchHandler(webapp2.RequestHandler):
+    """Base handler of the one-off tasks that work through every entity of a
+    kind: each task processes one batch of keys, then enqueues the task for
+    the next batch with a query cursor. The tasks of a run are named after
+    the run and their cursor, so a retried task doesn't start a second
+    chain. Subclasses set MODEL, URL and BATCH_SIZE and implement
+    process."""
+    MODEL = None
+    URL = None
+    BATCH_SIZE = 20
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
     def post(self):
-        """Update game listing announcement in memcache."""
-        HangmanApi._cache_average_attempts()
+        """Processes the batch of keys after the given cursor, or the first
+        batch, then enqueues the next batch"""
+        run = self.request.get('run') or str(int(time.time() * 1000))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = self.MODEL.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for key in keys:
+            self.process(key)
+        if more and next_cursor:
+            urlsafe_cursor = next_cursor.urlsafe()
+            utils.add_named_task(
+                self.URL, '{}-{}-{}'.format(
+                    self.URL.rsplit('/', 1)[-1], run,
+                    hashlib.md5(urlsafe_cursor).hexdigest()),
+                {'cursor': urlsafe_cursor, 'run': run})
+        else:
+            self.finish()
         self.response.set_status(204)
 
+    def process(self, key):
+        """Processes the entity with the given key"""
+        raise NotImplementedError
+
+    def finish(self):
+        """Called once the last batch has been processed"""
+
+
+class BackfillUserRank(BatchHandler):
+    MODEL = User
+    URL = '/tasks/backfill_user_rank'
+    BATCH_SIZE = 100
+
+    def process(self, key):
+        """Re-puts a User so its computed rank is stored and indexed. Only
+        needed once for Users written before the rank property existed."""
+        _reput_user(key)
+
+
+@ndb.transactional
+def _reput_user(key):
+    user = key.get()
+    if user:
+        user.put()
+
+
+class MigrateUserKeys(BatchHandler):
+    MODEL = User
+    URL = '/tasks/migrate_user_keys'
+
+    def process(self, key):
+        """Re-keys a User stored with a numeric id by its normalized name,
+        rewriting the user key of its Games and Scores and moving its
+        UserStats. Only needed once for Users created before Users were
+        keyed by name."""
+        if isinstance(key.id(), (int, long)):
+            _migrate_user(key)
+
+    def finish(self):
+        # Numeric ids sort before names, so any User left with one is first.
+        # It was skipped because its name is taken, and is only found with a
+        # query until it is renamed and the migration is run again.
+        key = User.query().order(User.key).get(keys_only=True)
+        if key and isinstance(key.id(), (int, long)):
+            logging.warning('Not finishing the user key migration: user %s '
+                            'was not migrated', key.id())
+            return
+        # Users can now always be found by their key.
+        Migration.mark_finished(USER_KEYS_MIGRATION)
+
+
+class BackfillUserStats(BatchHandler):
+    MODEL = User
+    URL = '/tasks/backfill_user_stats'
+
+    def process(self, key):
+        """Builds the UserStats of a User from its Score history. Only needed
+        once for Users who finished games before UserStats existed."""
+        _backfill_user_stats(key)
+
+
+def _backfill_user_stats(user_key):
+    stats = UserStats(key=UserStats.key_for_user(user_key))
+    for score in Score.query(Score.user == user_key).order(Score.date):
+        stats.record_game(score)
+    if stats.games_played:
+        ndb.transaction(lambda: _put_user_stats(stats))
+
+
+def _put_user_stats(stats):
+    # Games that ended since the scan are already counted in the stored
+    # stats; keep those rather than the older totals.
+    current = stats.key.get()
+    if not current or current.games_played < stats.games_played:
+        stats.put()
+
 
-app = webapp2.WSGIApplication([
+def _migrate_user(old_key):
+    user = old_key.get()
+    if not user:
+        return
+    new_key = User.key_for_name(user.name)
+    if not ndb.transaction(lambda: _move_user(old_key, new_key, False),
+                           xg=True):
+        logging.warning('Not migrating user %s: %s is already taken',
+                        old_key.id(), new_key.id())
+        return
+
+    for game_key in Game.query(Game.user == old_key).iter(keys_only=True):
+        ndb.transaction(lambda: _rekey_game(game_key, new_key))
+    scores = Score.query(Score.user == old_key).fetch()
+    for score in scores:
+        score.user = new_key
+    ndb.put_multi(scores)
+
+    # Pick up anything that changed on the old User while its games were
+    # being moved, then remove it.
+    ndb.transaction(lambda: _move_user(old_key, new_key, True), xg=True)
+
+
+def _move_user(old_key, new_key, delete_old):
+    """Moves a User's wins, losses and active games, including its counters,
+    its UserStats and its WindowScores in the open windows to its new key. They are added to the User at the new
+    key rather than copied over it, since games moved to the new key may
+    already have been rolled up into it. The old User keeps its name and is
+    left with zero totals, so moving it again adds nothing twice. Returns
+    False if the new key is taken by a different User."""
+    old_user, new_user = ndb.get_multi([old_key, new_key])
+    if not old_user:
+        return True
+    # A User with the same name is left over from an interrupted run.
+    if new_user and new_user.name != old_user.name:
+        return False
+    if not new_user:
+        new_user = User(key=new_key, name=old_user.name)
+    new_user.email = new_user.email or old_user.email
+    totals = User.drain_counters(old_key)
+    for name in USER_COUNTERS:
+        setattr(new_user, name, (getattr(new_user, name) +
+                                 getattr(old_user, name) + totals[name]))
+        setattr(old_user, name, 0)
+    new_user.put()
+    _move_user_stats(old_key, new_key)
+    leaderboards.move_scores(old_key, new_key, date.today())
+    if delete_old:
+        old_key.delete()
+    else:
+        old_user.put()
+    return True
+
+
+def _move_user_stats(old_key, new_key):
+    """Moves a User's UserStats, which are keyed by the User's id, to its new
+    key, merging them into any stats its games have recorded there"""
+    old_stats_key = UserStats.key_for_user(old_key)
+    old_stats, new_stats = ndb.get_multi(
+        [old_stats_key, UserStats.key_for_user(new_key)])
+    if not old_stats:
+        return
+    if new_stats:
+        new_stats.merge(old_stats)
+    else:
+        new_stats = old_stats
+        new_stats.key = UserStats.key_for_user(new_key)
+    new_stats.put()
+    old_stats_key.delete()
+
+
+def _rekey_game(game_key, new_key):
+    game = game_key.get()
+    if game:
+        game.user = new_key
+        game.put()
+
+
+class FoldMovesIntoGames(BatchHandler):
+    MODEL = Game
+    URL = '/tasks/fold_moves'
+
+    def process(self, key):
+        """Folds the Move entities of a Game into the Game's move log and
+        deletes them. Only needed once for Games played before moves were
+        recorded on the Game."""
+        moves = Move.query(Move.game == key).fetch()
+        if moves:
+            moves.sort(key=lambda move: move.move_index)
+            ndb.transaction(lambda: _fold_moves(key, moves))
+            ndb.delete_multi([move.key for move in moves])
+
+
+def _fold_moves(game_key, moves):
+    game = game_key.get()
+    if not game:
+        return
+    # A game played on after the switch logs its newer moves after these.
+    folded = [record.move for record in game.moves[:len(moves)]]
+    if folded == [move.move for move in moves]:
+        return
+    state = game.get_state()
+    game.moves = [move.to_record(game, state) for move in moves] + game.moves
+    game.put()
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Loads the dictionary, the hint indexes of its most common word
+        lengths, the models and the endpoints service before a new instance
+        serves its first request, and times each step. Called by App Engine when it starts an
+        instance."""
+        started = time.time()
+        word_bank = dictionaries.get_word_bank()
+        instrumentation.record_startup('warmup.word_bank', started)
+
+        solver_started = time.time()
+        solver.get_solver(word_bank).build_indexes()
+        instrumentation.record_startup('warmup.solver', solver_started)
+
+        api_started = time.time()
+        # Importing api builds the endpoints API server; the models were
+        # imported with this module.
+        import api
+        instrumentation.record_startup('warmup.api', api_started)
+        instrumentation.record_startup('warmup', started)
+        self.response.set_status(200)
+
+
+class AdminStats(webapp2.RequestHandler):
+    def get(self):
+        """Returns the aggregated request stats of every API method and
+        task/cron handler, and the startup timings, as JSON. Only available
+        to admins."""
+        from api import HangmanApi
+        routes = (['{}.{}'.format(HangmanApi.__name__, name)
+                   for name in HangmanApi.all_remote_methods()] +
+                  [path for path, _ in ROUTES])
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            {'requests': instrumentation.get_totals(routes),
+             'startup': instrumentation.get_startup_totals()},
+            indent=2, sort_keys=True))
+
+
+ROUTES = [
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
-], debug=True)
+    ('/tasks/send_reminder_chunk', SendReminderChunk),
+    ('/crons/reconcile_average_attempts', ReconcileAverageAttempts),
+    ('/tasks/update_highscores', UpdateHighScores),
+    ('/tasks/rebuild_highscores', RebuildHighScores),
+    ('/tasks/import_dictionary', ImportDictionary),
+    ('/tasks/rollup_user_counters', RollupUserCounters),
+    ('/tasks/record_user_stats', RecordUserStats),
+    ('/tasks/refresh_window_leaderboard', RefreshWindowLeaderboard),
+    ('/crons/compact_window_leaderboards', CompactWindowLeaderboards),
+    ('/tasks/backfill_window_leaderboards', BackfillWindowLeaderboards),
+    ('/tasks/backfill_user_rank', BackfillUserRank),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/fold_moves', FoldMovesIntoGames),
+    ('/admin/stats', AdminStats),
+    ('/_ah/warmup', Warmup),
+]
+
+app = instrumentation.middleware(webapp2.WSGIApplication(ROUTES, debug=True))
+instrumentation.record_startup('main', _IMPORT_STARTED)
@@ -2,94 +2,412 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
-import random
-import json
+import time
 from datetime import date
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.ext import db
 
+import counters
+import dictionaries
+import gamecache
+import gamestate
+import highscores
+import leaderboards
+import utils
+
+MEMCACHE_LEADERBOARD = 'LEADERBOARD'
+LEADERBOARD_SIZE = 100
+LEADERBOARD_EXPIRY = 60
+
+# The number of most recent days of games kept in a User's daily stats.
+USER_STATS_DAYS = 30
+# The number of most recent games a User's stats remember having recorded,
+# so a retried stats task doesn't count its game twice.
+USER_STATS_RECORDED_GAMES = 20
+USER_STATS_URL = '/tasks/record_user_stats'
+
+# Sharded counters of the number of active games and the sum of their
+# attempts remaining, used for the average attempts remaining statistic.
+ACTIVE_GAMES_COUNTERS = 'active_games'
+
+# Each User's wins, losses and active games are sharded counters, folded into
+# the User by a rollup task at most once every USER_ROLLUP_SECONDS.
+USER_COUNTERS = ('wins', 'losses', 'active_games')
+USER_COUNTER_SHARDS = 5
+USER_ROLLUP_SECONDS = 60
+
+# Set by /tasks/migrate_user_keys once every User is keyed by name.
+USER_KEYS_MIGRATION = 'user_keys'
+MEMCACHE_MIGRATION = 'migration:{}'
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by its normalized name. Games don't write the User:
+    they update its sharded counters, and wins, losses and active_games hold
+    the totals as of the last rollup."""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     wins = ndb.IntegerProperty(default=0)
     losses = ndb.IntegerProperty(default=0)
     active_games = ndb.IntegerProperty(default=0)
+    rank = ndb.ComputedProperty(lambda self: self.wins - self.losses)
+    # Finds Users not yet keyed by name, once written since it was added,
+    # regardless of the case of their name.
+    normalized_name = ndb.ComputedProperty(
+        lambda self: self.normalize_name(self.name))
+
+    @staticmethod
+    def normalize_name(name):
+        """Returns the form of a user name that Users are keyed by"""
+        return name.strip().lower()
 
-    def to_ranking_form(self):
+    @classmethod
+    def key_for_name(cls, name):
+        """Returns the key of the User with the given name"""
+        return ndb.Key(cls, cls.normalize_name(name))
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Returns a Future for the User with the given name, or None.
+        Users stored before they were keyed by name are found with a query,
+        by their exact name or, once written since normalized_name was added,
+        by their normalized name, until /tasks/migrate_user_keys has re-keyed
+        them all."""
+        if not name or not name.strip():
+            raise ndb.Return(None)
+        user = yield cls.key_for_name(name).get_async()
+        if not user:
+            migrated = yield Migration.is_finished_async(USER_KEYS_MIGRATION)
+            if not migrated:
+                user = yield cls.query(ndb.OR(
+                    cls.name == name,
+                    cls.normalized_name == cls.normalize_name(name))
+                ).get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Synchronous version of get_by_name_async"""
+        return cls.get_by_name_async(name).get_result()
+
+    def to_ranking_form(self, totals=None):
+        """Returns a RankingForm of the User. Pass the User's totals from
+        get_counter_totals to show the live rank rather than the rank as of
+        the last rollup."""
         form = RankingForm()
         form.user_name = self.name
-        form.rank = self.wins - self.losses
+        form.rank = totals['wins'] - totals['losses'] if totals else self.rank
         return form
 
+    @staticmethod
+    def counter_group(user_key):
+        """Returns the name of the counter group of a User"""
+        return 'user:{}'.format(user_key.urlsafe())
+
+    @classmethod
+    def increment_counters(cls, user_key, deltas):
+        """Adds to a User's counters without writing the User, so a User's
+        concurrent games don't contend for it. Inside a transaction the
+        counters are updated once it commits. A rollup of the counters into
+        the User is queued for the end of the current USER_ROLLUP_SECONDS
+        window.
+        Args:
+            user_key: The key of the User
+            deltas: A dict mapping names in USER_COUNTERS to the amount to add
+        """
+        counters.increment(cls.counter_group(user_key), deltas,
+                           USER_COUNTER_SHARDS)
+        utils.after_commit(cls._add_rollup_task, user_key)
+
+    @staticmethod
+    def _add_rollup_task(user_key):
+        # Named after the User and the window, so a User's updates within a
+        # window share a single rollup.
+        window = int(time.time()) // USER_ROLLUP_SECONDS
+        utils.add_named_task('/tasks/rollup_user_counters',
+                             'user-rollup-{}-{}'.format(user_key.urlsafe(),
+                                                        window),
+                             {'user_key': user_key.urlsafe()},
+                             countdown=USER_ROLLUP_SECONDS)
+
+    @classmethod
+    def rollup_counters(cls, user_key):
+        """Folds a User's counters into its wins, losses and active_games, so
+        its indexed rank and active_games are current for queries"""
+        user = utils.run_in_transaction(cls._rollup_counters, user_key)
+        if user:
+            user.update_leaderboard()
+
+    @classmethod
+    def _rollup_counters(cls, user_key):
+        user = user_key.get()
+        if not user:
+            return None
+        totals = cls.drain_counters(user_key)
+        if not any(totals.values()):
+            return None
+        for name in USER_COUNTERS:
+            setattr(user, name, getattr(user, name) + totals[name])
+        user.put()
+        return user
+
+    @classmethod
+    def drain_counters(cls, user_key):
+        """Zeroes a User's counters and returns their totals, to be added to
+        a User. Must be called inside a cross-group transaction.
+        Returns:
+            A dict mapping each name in USER_COUNTERS to its total."""
+        return counters.drain(cls.counter_group(user_key), USER_COUNTERS,
+                              USER_COUNTER_SHARDS)
+
+    @classmethod
+    def get_counter_totals(cls, users):
+        """Returns the live wins, losses and active_games of Users: the
+        totals stored on each User plus its counters, read with one memcache
+        get.
+        Args:
+            users: A list of Users
+        Returns:
+            A dict mapping each User's key to a dict of its totals.
+        """
+        counts = counters.get_counts_multi(
+            [cls.counter_group(user.key) for user in users], USER_COUNTERS,
+            USER_COUNTER_SHARDS)
+        return dict((user.key,
+                     dict((name, getattr(user, name) +
+                           counts[cls.counter_group(user.key)][name])
+                          for name in USER_COUNTERS))
+                    for user in users)
+
+    @classmethod
+    def get_leaderboard(cls):
+        """Returns the top LEADERBOARD_SIZE users ordered by rank, as a list of
+        (user_name, rank, urlsafe cursor after the user) tuples. The list is
+        cached in memcache so most calls are a single cache hit."""
+        leaderboard = memcache.get(MEMCACHE_LEADERBOARD)
+        if leaderboard is None:
+            leaderboard = []
+            users = cls.query().order(-cls.rank).iter(limit=LEADERBOARD_SIZE,
+                                                      produce_cursors=True)
+            for user in users:
+                leaderboard.append((user.name, user.rank,
+                                    users.cursor_after().urlsafe()))
+            memcache.set(MEMCACHE_LEADERBOARD, leaderboard,
+                         time=LEADERBOARD_EXPIRY)
+        return leaderboard
+
+    def update_leaderboard(self):
+        """Drops the cached leaderboard if this user's new rank changes it"""
+        leaderboard = memcache.get(MEMCACHE_LEADERBOARD)
+        if leaderboard is None:
+            return
+        if (len(leaderboard) < LEADERBOARD_SIZE or
+                self.rank >= leaderboard[-1][1] or
+                self.name in [name for name, _, _ in leaderboard]):
+            memcache.delete(MEMCACHE_LEADERBOARD)
+
+class MoveRecord(ndb.Model):
+    """A move in a Game's move log: a letter or word guess and whether it was
+    correct"""
+    move = ndb.StringProperty(required=True)
+    correct = ndb.BooleanProperty(required=True)
+
+    def to_form(self):
+        if len(self.move) > 1:
+            #Word guess
+            if self.correct:
+                message = "Correct!"
+            else:
+                message = "Incorrect."
+        else:
+            #Letter guess
+            if self.correct:
+                message = "Letter is in the word!"
+            else:
+                message = "Letter is not in the word."
+        return MoveForm(move=self.move, message=message)
+
+
 class Game(ndb.Model):
     """Game object"""
     target = ndb.StringProperty(required=True)
     guessed_letters = ndb.StringProperty(required=True)
+    target_mask = ndb.IntegerProperty(indexed=False)
+    guessed_mask = ndb.IntegerProperty(indexed=False)
     attempts_allowed = ndb.IntegerProperty(required=True)
     attempts_remaining = ndb.IntegerProperty(required=True, default=5)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
+    moves = ndb.LocalStructuredProperty(MoveRecord, repeated=True)
+    # Bumped by every put, so clients can tell whether a game has changed.
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # The owner's name, when the code putting the game already knows it. Not
+    # stored; it lets the put write the game to the cache even when it has
+    # no entry yet.
+    owner_name = None
 
     @classmethod
-    def new_game(cls, user, attempts):
-        """Creates and returns a new game"""
-
-        with open('words.json') as words_file:    
-            word_list = json.load(words_file)
-
-        word = word_list[random.choice(range(1, len(word_list) + 1))]
+    def new_game(cls, user, attempts, word_length=None, difficulty=None):
+        """Creates and returns a new game. The target word can optionally be
+        limited to a word length and/or a difficulty level."""
+        word = dictionaries.choose_word(word_length, difficulty)
 
         game = Game(user=user.key,
                     target=word,
                     guessed_letters='',
+                    target_mask=gamestate.letters_mask(word),
+                    guessed_mask=0,
                     attempts_allowed=attempts,
                     attempts_remaining=attempts,
                     game_over=False)
-        game.put()
-
-        user.active_games = user.active_games + 1
-        user.put()
-
+        game.owner_name = user.name
+        utils.run_in_transaction(game._start)
         return game
 
-    def to_form(self, message=''):
-        """Returns a GameForm representation of the Game"""
+    def _start(self):
+        self.put()
+        User.increment_counters(self.user, {'active_games': 1})
+        counters.increment(ACTIVE_GAMES_COUNTERS,
+                           {'count': 1,
+                            'attempts_remaining': self.attempts_remaining})
+
+    def get_state(self):
+        """Returns the GameState of the Game. Games stored before the masks
+        existed have them computed from their letters."""
+        guessed_mask = self.guessed_mask
+        if guessed_mask is None:
+            guessed_mask = gamestate.letters_mask(self.guessed_letters)
+        return gamestate.GameState(self.target, guessed_mask, self.target_mask)
+
+    def guess_letter(self, state, letter):
+        """Records a valid letter guess in the Game and its GameState.
+        Returns True if the letter is in the target word."""
+        letter = letter.lower()
+        correct = state.guess(letter)
+        self.guessed_letters = self.guessed_letters + letter
+        self.target_mask = state.target_mask
+        self.guessed_mask = state.guessed_mask
+        return correct
+
+    def record_move(self, move, correct):
+        """Appends a move to the Game's move log"""
+        self.moves.append(MoveRecord(move=move, correct=correct))
+
+    def use_attempt(self):
+        """Spends one of the game's remaining attempts. The caller takes the
+        attempts it spends off the active games counters with
+        count_attempts_used, once for all of the moves it applies."""
+        self.attempts_remaining -= 1
+
+    @staticmethod
+    def count_attempts_used(attempts):
+        """Takes attempts spent by moves off the active games counters.
+        Inside a transaction the counters are updated once it commits."""
+        counters.increment(ACTIVE_GAMES_COUNTERS,
+                           {'attempts_remaining': -attempts})
+
+    @staticmethod
+    def get_average_attempts():
+        """Returns the average attempts remaining of active games, or None
+        if there are no active games"""
+        totals = counters.get_counts(ACTIVE_GAMES_COUNTERS,
+                                     ['count', 'attempts_remaining'])
+        if totals['count'] <= 0:
+            return None
+        return float(totals['attempts_remaining']) / totals['count']
+
+    @ndb.tasklet
+    def to_form_async(self, message='', user_name=None):
+        """Returns a Future for a GameForm representation of the Game. Pass
+        user_name when the owner has already been fetched to avoid another
+        datastore get."""
+        if not user_name:
+            user = yield self.user.get_async()
+            user_name = user.name
         if message:
             form = GameMessageForm()
             form.message = message
         else:
             form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name
+        form.attempts_remaining = self.attempts_remaining
+        form.game_over = self.game_over
+        form.version = self.version
+        raise ndb.Return(form)
+
+    def to_form(self, message='', user_name=None):
+        """Returns a GameForm representation of the Game"""
+        return self.to_form_async(message, user_name).get_result()
+
+    def to_moves_form(self, move_messages, user_name=None):
+        """Returns a GameMovesForm representation of the Game, with the
+        message of each move made"""
+        form = GameMovesForm(move_messages=move_messages)
+        form.urlsafe_key = self.key.urlsafe()
+        form.user_name = user_name or self.user.get().name
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
+        form.version = self.version
         return form
 
-    def end_game(self, won=False):
+    @ndb.tasklet
+    def end_game_async(self, won=False, user_name=None):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. Nothing is written here: the caller puts the returned
+        entities, normally together in one transaction.
+        Neither the User nor its UserStats is read or written, so a User's
+        concurrent games don't contend for them: the User's counters are
+        updated once the transaction commits, and its stats by a task queued
+        with the transaction.
+        Args:
+            won: Whether the player won
+            user_name: The name of the game's User, if it is already known.
+                Pass it to keep a won game from reading the User.
+        Returns:
+            A Future for a list of the entities to put: the Game and its new
+            Score."""
         self.game_over = True
-        self.put()
+        counters.increment(ACTIVE_GAMES_COUNTERS,
+                           {'count': -1,
+                            'attempts_remaining': -self.attempts_remaining})
         # Add the game to the score 'board'
         score = Score(user=self.user, date=date.today(), won=won,
                       guesses=self.attempts_allowed - self.attempts_remaining)
-        score.put()
 
-        # Update the user's wins/losses
-        user = self.user.get()
+        yield UserStats.add_record_task_async(self, score)
+        User.increment_counters(self.user, {'wins': 1 if won else 0,
+                                            'losses': 0 if won else 1,
+                                            'active_games': -1})
+        leaderboards.record_game(self.user, won, score.date)
         if won:
-            user.wins = user.wins + 1
-        else:
-            user.losses = user.losses + 1
-        user.active_games = user.active_games - 1
-        user.put()
+            # The user's name is only needed for the high scores.
+            if not user_name:
+                user = yield self.user.get_async()
+                user_name = user.name
+            yield highscores.add_async(self, score, user_name)
+        raise ndb.Return([self, score])
+
+    def end_game(self, won=False, user_name=None):
+        """Synchronous version of end_game_async"""
+        return self.end_game_async(won, user_name).get_result()
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+        # Keep the game state cache in step with every put. Inside a
+        # transaction the cache is only updated once the put has committed.
+        if ndb.in_transaction():
+            utils.after_commit(gamecache.update, self, self.owner_name)
+        elif self.key:
+            gamecache.invalidate(self.key)
 
     def delete(self):
-        print("test")
         db.delete(db.Key(self.key.urlsafe()))
+        gamecache.invalidate(self.key)
 
 
 class Score(ndb.Model):
@@ -99,33 +417,199 @@ class Score(ndb.Model):
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
 
+    @ndb.tasklet
+    def to_form_async(self, user_name=None):
+        """Returns a Future for a ScoreForm representation of the Score. Pass
+        user_name when the owner has already been fetched to avoid another
+        datastore get."""
+        if not user_name:
+            user = yield self.user.get_async()
+            user_name = user.name
+        raise ndb.Return(ScoreForm(user_name=user_name, won=self.won,
+                                   date=str(self.date), guesses=self.guesses))
+
+    def to_form(self, user_name=None):
+        """Returns a ScoreForm representation of the Score"""
+        return self.to_form_async(user_name).get_result()
+
+
+class DailyStats(ndb.Model):
+    """The games a User finished on one day"""
+    date = ndb.DateProperty(required=True)
+    games_played = ndb.IntegerProperty(default=0)
+    wins = ndb.IntegerProperty(default=0)
+
     def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
-                         date=str(self.date), guesses=self.guesses)
+        return DailyStatsForm(date=str(self.date),
+                              games_played=self.games_played, wins=self.wins)
+
+
+class UserStats(ndb.Model):
+    """Running totals of a User's finished games, keyed by the User's id and
+    updated by a task queued as each game ends"""
+    games_played = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    total_guesses = ndb.IntegerProperty(default=0, indexed=False)
+    best_guesses = ndb.IntegerProperty(indexed=False)
+    current_streak = ndb.IntegerProperty(default=0, indexed=False)
+    longest_streak = ndb.IntegerProperty(default=0, indexed=False)
+    daily = ndb.LocalStructuredProperty(DailyStats, repeated=True)
+    recorded_games = ndb.StringProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for_user(cls, user_key):
+        """Returns the key of a User's UserStats"""
+        return ndb.Key(cls, user_key.id())
+
+    @staticmethod
+    def add_record_task_async(game, score):
+        """Queues a task that adds a finished game's Score to its User's
+        UserStats. Inside a transaction the task is only added if the
+        transaction commits."""
+        return taskqueue.add_async(
+            url=USER_STATS_URL,
+            params={'game_key': game.key.urlsafe(),
+                    'user_key': score.user.urlsafe(),
+                    'date': score.date.isoformat(),
+                    'won': 'true' if score.won else '',
+                    'guesses': str(score.guesses)},
+            transactional=ndb.in_transaction())
+
+    @classmethod
+    def record_finished_game(cls, game_key, score):
+        """Adds a finished game's Score to its User's UserStats, unless the
+        game has already been recorded: a task can run more than once."""
+        utils.run_in_transaction(cls._record_finished_game, game_key, score)
+
+    @classmethod
+    def _record_finished_game(cls, game_key, score):
+        key = cls.key_for_user(score.user)
+        stats = key.get() or cls(key=key)
+        if game_key.urlsafe() in stats.recorded_games:
+            return
+        stats.record_game(score)
+        stats.recorded_games = (stats.recorded_games + [game_key.urlsafe()])[
+            -USER_STATS_RECORDED_GAMES:]
+        stats.put()
+
+    def record_game(self, score):
+        """Adds a finished game's Score to the totals"""
+        self.games_played += 1
+        self.total_guesses += score.guesses
+        if score.won:
+            self.wins += 1
+            self.current_streak += 1
+            self.longest_streak = max(self.longest_streak,
+                                      self.current_streak)
+            if self.best_guesses is None or score.guesses < self.best_guesses:
+                self.best_guesses = score.guesses
+        else:
+            self.current_streak = 0
+
+        if not self.daily or self.daily[-1].date != score.date:
+            self.daily.append(DailyStats(date=score.date))
+            self.daily = self.daily[-USER_STATS_DAYS:]
+        self.daily[-1].games_played += 1
+        if score.won:
+            self.daily[-1].wins += 1
+
+    def merge(self, earlier):
+        """Adds the totals of another UserStats of the same User, covering
+        games that ended before any of these"""
+        if self.current_streak == self.games_played:
+            # Every one of these games was won.
+            self.current_streak += earlier.current_streak
+        self.longest_streak = max(self.longest_streak, earlier.longest_streak,
+                                  self.current_streak)
+        self.games_played += earlier.games_played
+        self.wins += earlier.wins
+        self.total_guesses += earlier.total_guesses
+        if self.best_guesses is None or (
+                earlier.best_guesses is not None and
+                earlier.best_guesses < self.best_guesses):
+            self.best_guesses = earlier.best_guesses
+
+        daily = dict((day.date, day) for day in earlier.daily)
+        for day in self.daily:
+            if day.date in daily:
+                day.games_played += daily[day.date].games_played
+                day.wins += daily[day.date].wins
+            daily[day.date] = day
+        self.daily = sorted(daily.values(),
+                            key=lambda day: day.date)[-USER_STATS_DAYS:]
+        self.recorded_games = (earlier.recorded_games + self.recorded_games)[
+            -USER_STATS_RECORDED_GAMES:]
+
+    def to_form(self, user_name, active_games=0):
+        form = UserStatsForm(user_name=user_name,
+                             active_games=active_games,
+                             games_played=self.games_played,
+                             wins=self.wins,
+                             best_guesses=self.best_guesses,
+                             current_streak=self.current_streak,
+                             longest_streak=self.longest_streak,
+                             daily=[day.to_form() for day in self.daily])
+        if self.games_played:
+            form.win_rate = float(self.wins) / self.games_played
+            form.average_guesses = (float(self.total_guesses) /
+                                    self.games_played)
+        return form
 
 
 class Move(ndb.Model):
-    """Move object"""
+    """Move object. Moves are now recorded in Game.moves; these entities are
+    only read to fold them into their Games."""
     game = ndb.KeyProperty(required=True, kind='Game')
     move = ndb.StringProperty(required=True)
     move_index = ndb.IntegerProperty(required=True)
 
-
-    def to_form(self):
-        game = self.game.get()
+    def to_record(self, game, state):
+        """Returns the MoveRecord of the Move, given its Game and the Game's
+        GameState"""
         if len(self.move) > 1:
-            #Word guess
-            if self.move == game.target:
-                message = "Correct!"
-            else:
-                message = "Incorrect."
+            correct = self.move == game.target
         else:
-            #Letter guess
-            if self.move in game.target:
-                message = "Letter is in the word!"
-            else:
-                message = "Letter is not in the word."
-        return MoveForm(move=self.move, message=message)
+            correct = state.contains(self.move)
+        return MoveRecord(move=self.move, correct=correct)
+
+
+class Migration(ndb.Model):
+    """Marks a one-off data migration as finished, keyed by its name"""
+    finished = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    @ndb.tasklet
+    def is_finished_async(cls, name):
+        """Returns a Future for whether a migration has finished. The answer
+        is cached in memcache, and kept per instance once it is True."""
+        if name in _finished_migrations:
+            raise ndb.Return(True)
+        context = ndb.get_context()
+        memcache_key = MEMCACHE_MIGRATION.format(name)
+        finished = yield context.memcache_get(memcache_key)
+        if finished is None:
+            migration = yield ndb.Key(cls, name).get_async()
+            finished = migration is not None
+            yield context.memcache_add(memcache_key, finished)
+        if finished:
+            _finished_migrations.add(name)
+        raise ndb.Return(finished)
+
+    @classmethod
+    def mark_finished(cls, name):
+        """Records that a migration has finished"""
+        cls(id=name).put()
+        memcache.set(MEMCACHE_MIGRATION.format(name), True)
+
+
+_finished_migrations = set()
+
+
+class ReminderLog(ndb.Model):
+    """Records the Users already reminded by one chunk of a reminder run,
+    keyed by '<run id>:<chunk index>'"""
+    sent = ndb.KeyProperty(kind='User', repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
 
 
 class MoveForm(messages.Message):
@@ -137,6 +621,8 @@ class MoveForm(messages.Message):
 class MoveForms(messages.Message):
     """MoveForms for showing all the moves in a game"""
     items = messages.MessageField(MoveForm, 1, repeated=True)
+    version = messages.IntegerField(2)
+    not_modified = messages.BooleanField(3)
 
 
 class GameForm(messages.Message):
@@ -145,6 +631,7 @@ class GameForm(messages.Message):
     attempts_remaining = messages.IntegerField(2, required=True)
     game_over = messages.BooleanField(3, required=True)
     user_name = messages.StringField(4, required=True)
+    version = messages.IntegerField(5)
 
 
 class GameMessageForm(messages.Message):
@@ -154,11 +641,26 @@ class GameMessageForm(messages.Message):
     game_over = messages.BooleanField(3, required=True)
     message = messages.StringField(4, required=True)
     user_name = messages.StringField(5, required=True)
+    version = messages.IntegerField(6)
+    not_modified = messages.BooleanField(7)
+
+
+class GameMovesForm(messages.Message):
+    """GameForm for outbound game state information after several moves,
+    including the message of each move"""
+    urlsafe_key = messages.StringField(1, required=True)
+    attempts_remaining = messages.IntegerField(2, required=True)
+    game_over = messages.BooleanField(3, required=True)
+    move_messages = messages.StringField(4, repeated=True)
+    user_name = messages.StringField(5, required=True)
+    version = messages.IntegerField(6)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
+    word_length = messages.IntegerField(2)
+    difficulty = messages.IntegerField(3)
     attempts = messages.IntegerField(4, default=5)
 
 
@@ -167,11 +669,24 @@ class MakeMoveForm(messages.Message):
     letter_guess = messages.StringField(1, required=True)
 
 
+class MakeMovesForm(messages.Message):
+    """Used to make several letter guesses in an existing game"""
+    letter_guesses = messages.StringField(1, repeated=True)
+
+
 class GuessAnswerForm(messages.Message):
     """Used to guess an answer in an existing game"""
     word_guess = messages.StringField(1, required=True)
 
 
+class HintForm(messages.Message):
+    """HintForm for the suggested next letter guess of a game"""
+    urlsafe_key = messages.StringField(1, required=True)
+    letter = messages.StringField(2)
+    candidates = messages.IntegerField(3, required=True)
+    message = messages.StringField(4, required=True)
+
+
 class RankingForm(messages.Message):
     """Used to guess an answer in an existing game"""
     user_name = messages.StringField(1, required=True)
@@ -188,14 +703,36 @@ class ScoreForm(messages.Message):
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class RankingForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(RankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+class DailyStatsForm(messages.Message):
+    """The games a User finished on one day"""
+    date = messages.StringField(1, required=True)
+    games_played = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+
+class UserStatsForm(messages.Message):
+    """UserStatsForm for outbound totals of a User's finished games"""
+    user_name = messages.StringField(1, required=True)
+    games_played = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    win_rate = messages.FloatField(4)
+    best_guesses = messages.IntegerField(5)
+    average_guesses = messages.FloatField(6)
+    current_streak = messages.IntegerField(7, required=True)
+    longest_streak = messages.IntegerField(8, required=True)
+    daily = messages.MessageField(DailyStatsForm, 9, repeated=True)
+    active_games = messages.IntegerField(10)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
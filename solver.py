@@ -0,0 +1,175 @@
+"""solver.py - Suggests the letter most likely to be in a Hangman word.
+
+For each word length the dictionary is indexed once per instance as bitmaps,
+Python integers with one bit per word of that length: for every position and
+letter, the words with that letter at that position, and for every letter,
+the words containing it. Filtering the candidates for a pattern is then a
+handful of AND operations over every word of the length at once, and
+counting the candidates that contain a letter is an AND and a bit count.
+Hints are cached per (pattern, wrong letters) in a bounded LRU cache."""
+
+import binascii
+import collections
+import threading
+
+import gamestate
+
+# Suggested, in order, when no dictionary word matches the pattern.
+FALLBACK_ORDER = 'etaoinshrdlucmfwypvbgkjqxz'
+CACHE_SIZE = 4096
+# The most memory the indexes built while warming up may take. The lengths
+# with the most words, which new games are most likely to use, are built
+# first; the rest are built on first use.
+WARMUP_INDEX_BYTES = 8 * 1024 * 1024
+
+Hint = collections.namedtuple('Hint', ['letter', 'candidates'])
+
+
+def _to_int(data):
+    """Returns the integer of a little endian bytearray of bits"""
+    data.reverse()
+    return int(binascii.hexlify(bytes(data)) or b'0', 16)
+
+
+def _count(bitmap):
+    return bin(bitmap).count('1')
+
+
+class LengthIndex(object):
+    """Bitmap index over the words of one length. Only the bitmaps are kept,
+    not the words."""
+    __slots__ = ('size', 'all', 'at', 'contains')
+
+    def __init__(self, words, size):
+        """Args:
+            words: An iterable of the words of the length, read once
+            size: The number of words
+        """
+        self.size = size
+        data_size = (size + 7) // 8
+        at = collections.defaultdict(lambda: bytearray(data_size))
+        contains = collections.defaultdict(lambda: bytearray(data_size))
+        for index, word in enumerate(words):
+            byte, bit = index // 8, 1 << (index % 8)
+            for position, letter in enumerate(word):
+                at[(position, letter)][byte] |= bit
+                contains[letter][byte] |= bit
+        self.all = (1 << size) - 1
+        # at[(position, letter)]: the words with letter at position
+        self.at = dict((key, _to_int(at.pop(key))) for key in list(at))
+        # contains[letter]: the words with letter anywhere
+        self.contains = dict((letter, _to_int(contains.pop(letter)))
+                             for letter in list(contains))
+
+    @staticmethod
+    def estimate_bytes(word_length, size):
+        """Returns roughly how much memory the index of size words of a
+        length takes: at most one bitmap per position and letter, and one
+        per letter"""
+        return (word_length + 1) * len(gamestate.LETTERS) * ((size + 7) // 8)
+
+    def candidates(self, pattern, wrong_letters):
+        """Returns the bitmap of the words matching a pattern, with '_' for
+        each unrevealed letter, that contain none of the wrong letters"""
+        revealed = set(pattern) - set('_')
+        candidates = self.all
+        for position, letter in enumerate(pattern):
+            if letter != '_':
+                candidates &= self.at.get((position, letter), 0)
+            else:
+                # A revealed letter is shown at every position it is at.
+                for revealed_letter in revealed:
+                    candidates &= ~self.at.get((position, revealed_letter), 0)
+            if not candidates:
+                return 0
+        for letter in wrong_letters:
+            candidates &= ~self.contains.get(letter, 0)
+        return candidates
+
+    def hint(self, pattern, wrong_letters):
+        """Returns the Hint of the unguessed letter in the most candidate
+        words"""
+        candidates = self.candidates(pattern, wrong_letters)
+        guessed = set(pattern) | set(wrong_letters)
+        best_letter, best_count = None, 0
+        for letter in gamestate.LETTERS:
+            if letter in guessed:
+                continue
+            count = _count(candidates & self.contains.get(letter, 0))
+            if count > best_count:
+                best_letter, best_count = letter, count
+        if best_letter is None:
+            best_letter = next((letter for letter in FALLBACK_ORDER
+                                if letter not in guessed), None)
+        return Hint(best_letter, _count(candidates))
+
+
+class Solver(object):
+    """Hints over one dictionary. Each length is indexed on first use, or
+    while warming up by build_indexes."""
+
+    def __init__(self, word_bank):
+        self._word_bank = word_bank
+        self._indexes = {}
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _index(self, word_length):
+        # Built without holding the lock, so hints for other lengths and
+        # cached hints aren't held up. Requests that race to build the same
+        # length all use the index stored first.
+        index = self._indexes.get(word_length)
+        if index is None:
+            index = self._indexes.setdefault(
+                word_length,
+                LengthIndex(self._word_bank.iter_words(word_length),
+                            self._word_bank.count_words(word_length)))
+        return index
+
+    def build_indexes(self, budget_bytes=WARMUP_INDEX_BYTES):
+        """Indexes the word lengths with the most words, as many as fit in a
+        memory budget, so most requests don't wait for an index to be built.
+        Returns:
+            The word lengths indexed."""
+        counts = self._word_bank.length_counts()
+        built = []
+        for word_length in sorted(counts, key=counts.get, reverse=True):
+            size = LengthIndex.estimate_bytes(word_length, counts[word_length])
+            if size > budget_bytes:
+                continue
+            budget_bytes -= size
+            self._index(word_length)
+            built.append(word_length)
+        return built
+
+    def hint(self, pattern, wrong_letters):
+        """Returns the Hint for a revealed pattern and the wrong letters
+        guessed so far.
+        Args:
+            pattern: The target word with '_' for each unrevealed letter
+            wrong_letters: The guessed letters that are not in the word
+        """
+        key = (pattern, ''.join(sorted(wrong_letters)))
+        with self._lock:
+            hint = self._cache.pop(key, None)
+            if hint is not None:
+                self._cache[key] = hint
+                return hint
+        hint = self._index(len(pattern)).hint(*key)
+        with self._lock:
+            self._cache[key] = hint
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return hint
+
+
+_solver = None
+
+
+def get_solver(word_bank):
+    """Returns the instance wide Solver of a WordBank, building a new one
+    when the dictionary has changed"""
+    global _solver
+    if _solver is None or _solver._word_bank is not word_bank:
+        _solver = Solver(word_bank)
+    return _solver
@@ -2,20 +2,29 @@
 
 import re
 import logging
+import functools
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+TRANSACTION_RETRIES = 5
+# While a cached value is being invalidated, readers can't add back a copy
+# they may have read before the write.
+INVALIDATE_LOCK_SECONDS = 5
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string encodes, without
+        fetching the entity. Checks that the key is of the correct kind.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key that the urlsafe Key string encodes.
     Raises:
         ValueError:"""
     try:
@@ -28,30 +37,120 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
 
-def valid_letter_guess(guess, guessed_letters):
-    """Validates a hangman guess based on the previously guessed letters.
+def run_in_transaction(func, *args, **kwargs):
+    """Runs func in a cross-group transaction, retrying it up to
+    TRANSACTION_RETRIES times if it collides with a concurrent write.
     Args:
-        guess: The guess to be validated
-        guessed_letters: The letters previously guessed in this game
+        func: The function to run. It may be run more than once, so it must
+            only change the datastore through the transaction.
     Returns:
-        True if the guess is an alpha character and is not in the list of 
-        guessed_characters. False otherwise.
+        The return value of func.
     """
-    if not guess.isalpha():
-        return False
-    elif len(guess) is not 1:
-        return False
-    elif guess.lower() in guessed_letters:
-        return False
+    return ndb.transaction(lambda: func(*args, **kwargs), xg=True,
+                           retries=TRANSACTION_RETRIES)
+
+def after_commit(func, *args, **kwargs):
+    """Runs func once the current transaction commits, or straight away when
+    there is no transaction. Used for side effects such as memcache updates
+    that must not be repeated if the transaction is retried."""
+    callback = functools.partial(func, *args, **kwargs)
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(callback)
     else:
-        return True
+        callback()
+
+def invalidate_memcache(*keys):
+    """Drops cached values and blocks readers from adding them back for
+    INVALIDATE_LOCK_SECONDS, so they can't cache a value read before the
+    write that invalidated it."""
+    memcache.delete_multi(list(keys), seconds=INVALIDATE_LOCK_SECONDS)
+
+def add_named_task(url, name, params, countdown=None):
+    """Adds a task to the default queue unless a task with the same name has
+    already been added. Naming a task after the work it does keeps a retried
+    caller from adding that work twice.
+    Args:
+        url: The handler of the task
+        name: The task's name, unique to the work it does
+        params: A dict of the task's parameters
+        countdown: The seconds to wait before running the task, if any
+    """
+    try:
+        taskqueue.add(url=url, name=name, params=params, countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def get_page_size(page_size):
+    """Returns the requested page size, defaulted and capped.
+    Raises:
+        endpoints.BadRequestException: If the page size is not positive
+    """
+    if page_size is not None and page_size < 1:
+        raise endpoints.BadRequestException('page_size must be positive')
+    return min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+
+def get_number_of_results(number_of_results, maximum):
+    """Returns the requested number of results, defaulted and capped to
+    maximum.
+    Raises:
+        endpoints.BadRequestException: If the number is not positive
+    """
+    if number_of_results is not None and number_of_results < 1:
+        raise endpoints.BadRequestException(
+            'number_of_results must be positive')
+    return min(number_of_results or maximum, maximum)
+
+@ndb.tasklet
+def fetch_page_async(query, page_size=None, urlsafe_cursor=None):
+    """Fetches one page of a query, resuming from a urlsafe cursor.
+    Args:
+        query: The ndb.Query to page through
+        page_size: The number of results wanted, capped at MAX_PAGE_SIZE.
+            Defaults to DEFAULT_PAGE_SIZE
+        urlsafe_cursor: The next_cursor returned with the previous page
+    Returns:
+        A Future for a (results, next_cursor) tuple. next_cursor is None on
+        the last page.
+    Raises:
+        endpoints.BadRequestException: If the page size or cursor is invalid
+    """
+    page_size = get_page_size(page_size)
+    try:
+        cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+    results, next_cursor, more = yield query.fetch_page_async(
+        page_size, start_cursor=cursor)
+    if more and next_cursor:
+        raise ndb.Return((results, next_cursor.urlsafe()))
+    raise ndb.Return((results, None))
+
+def fetch_page(query, page_size=None, urlsafe_cursor=None):
+    """Synchronous version of fetch_page_async"""
+    return fetch_page_async(query, page_size, urlsafe_cursor).get_result()
+
+@ndb.tasklet
+def get_user_names_async(entities):
+    """Resolves the owners of a page of entities with one batched get.
+    Args:
+        entities: ndb.Model entities with a 'user' KeyProperty
+    Returns:
+        A Future for a dict mapping each distinct User key to that User's
+        name.
+    """
+    keys = list(set(entity.user for entity in entities))
+    users = yield ndb.get_multi_async(keys)
+    raise ndb.Return(dict((key, user.name)
+                          for key, user in zip(keys, users) if user))
+
+def get_user_names(entities):
+    """Synchronous version of get_user_names_async"""
+    return get_user_names_async(entities).get_result()
 
 def valid_word_guess(guess):
     """Validates a hangman guess based on the previously guessed letters.
@@ -63,23 +162,3 @@ def valid_word_guess(guess):
         guessed_characters. False otherwise.
     """
     return guess.isalpha()
-
-def guessed_letters_are_correct(guessed_letters, target):
-    """
-    """
-    for char in target:
-        if char not in guessed_letters:
-            return False
-    return True
-
-def show_hyphenated_progress(guessed_letters, target):
-    """
-    """
-    hyphenated_progress = ''
-    for char in target:
-        if char in guessed_letters:
-            hyphenated_progress = hyphenated_progress + char + ' '
-        else:
-            hyphenated_progress = hyphenated_progress + '_ '
-
-    return hyphenated_progress
\ No newline at end of file
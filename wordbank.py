@@ -0,0 +1,230 @@
+"""wordbank.py - A packed, read-only word list from which a target word can
+be picked in constant time without loading the list into Python objects.
+
+Words are bucketed by their length and by their number of distinct letters.
+Every guess in Hangman costs an attempt, so the number of distinct letters in
+a word is what makes it harder to solve.
+
+The packed format (all integers little endian) is:
+    header      magic 'HWB1', word count, bucket count, data size (uint32s)
+    directory   per bucket: length (uint8), distinct letters (uint8), two
+                bytes of padding, index of its first word and its word count
+                (uint32s)
+    offsets     word count + 1 uint32 offsets of each word in the data
+    data        the words, sorted by bucket, as ASCII with no separators
+
+A bucket's words are a contiguous run of word indexes, so a random word is a
+random index into the matching buckets and one read of two offsets. The file
+is memory-mapped where mmap is available and read into a single string where
+it isn't (as in the App Engine sandbox). Either way the words are never held
+as a list. build_dictionary.py packs words.json or a text word list into this
+format."""
+
+import json
+import os
+import random
+import struct
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+WORDS_FILE = 'words.json'
+PACKED_WORDS_FILE = 'words.bin'
+
+MAGIC = b'HWB1'
+HEADER = struct.Struct('<4sIII')
+BUCKET = struct.Struct('<BBxxII')
+OFFSET = struct.Struct('<I')
+OFFSET_PAIR = struct.Struct('<II')
+
+DIFFICULTY_EASY = 1
+DIFFICULTY_MEDIUM = 2
+DIFFICULTY_HARD = 3
+
+# Inclusive (min, max) number of distinct letters for each difficulty.
+DIFFICULTY_DISTINCT_LETTERS = {
+    DIFFICULTY_EASY: (1, 4),
+    DIFFICULTY_MEDIUM: (5, 6),
+    DIFFICULTY_HARD: (7, 26),
+}
+
+
+def is_valid_word(word):
+    """Returns True if a word can be packed: 1 to 255 ASCII letters"""
+    return (0 < len(word) < 256 and word.isalpha() and
+            all(ord(letter) < 128 for letter in word))
+
+
+def pack_words(words):
+    """Packs a word list. Words that aren't valid are skipped and duplicates
+    are dropped.
+    Args:
+        words: An iterable of words
+    Returns:
+        The packed word list as a byte string."""
+    buckets = {}
+    for word in words:
+        word = word.strip().lower()
+        if is_valid_word(word):
+            buckets.setdefault((len(word), len(set(word))), set()).add(
+                word.encode('ascii'))
+
+    directory = []
+    offsets = [0]
+    data = []
+    for bucket_key in sorted(buckets):
+        bucket = sorted(buckets[bucket_key])
+        directory.append(BUCKET.pack(bucket_key[0], bucket_key[1],
+                                     len(offsets) - 1, len(bucket)))
+        for word in bucket:
+            data.append(word)
+            offsets.append(offsets[-1] + len(word))
+
+    return b''.join([HEADER.pack(MAGIC, len(offsets) - 1, len(directory),
+                                 offsets[-1])] +
+                    directory +
+                    [struct.pack('<{}I'.format(len(offsets)), *offsets)] +
+                    data)
+
+
+def packed_size(header):
+    """Returns the total size of a packed word list from its header bytes"""
+    magic, word_count, bucket_count, data_size = HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise ValueError('Not a packed word list')
+    return (HEADER.size + BUCKET.size * bucket_count +
+            OFFSET.size * (word_count + 1) + data_size)
+
+
+class WordBank(object):
+    """Read-only index over a packed word list.
+
+    Only the bucket directory is unpacked. The offsets and words are read
+    from the buffer as they are needed."""
+    __slots__ = ('_buffer', '_word_count', '_offsets_start', '_data_start',
+                 '_buckets', '_ranges')
+
+    def __init__(self, buffer):
+        """Args:
+            buffer: The packed word list, as a string, a bytearray or a
+                read-only mmap
+        Raises:
+            ValueError: If the buffer is not a complete packed word list."""
+        if len(buffer) < HEADER.size or len(buffer) != packed_size(buffer):
+            raise ValueError('Not a complete packed word list')
+        _, word_count, bucket_count, _ = HEADER.unpack_from(buffer)
+        self._buffer = buffer
+        self._word_count = word_count
+        self._offsets_start = HEADER.size + BUCKET.size * bucket_count
+        self._data_start = self._offsets_start + OFFSET.size * (word_count + 1)
+        self._buckets = tuple(
+            BUCKET.unpack_from(buffer, HEADER.size + BUCKET.size * index)
+            for index in range(bucket_count))
+        self._ranges = {}
+
+    @classmethod
+    def from_words(cls, words):
+        """Returns a WordBank of a word list, packed in memory"""
+        return cls(pack_words(words))
+
+    def __len__(self):
+        return self._word_count
+
+    def word(self, index):
+        """Returns the word at an index of the packed list"""
+        start, end = OFFSET_PAIR.unpack_from(
+            self._buffer, self._offsets_start + OFFSET.size * index)
+        return self._buffer[self._data_start + start:
+                            self._data_start + end].decode('ascii')
+
+    def length_counts(self):
+        """Returns a dict mapping each word length in the list to its number
+        of words"""
+        counts = {}
+        for length, _, _, count in self._buckets:
+            counts[length] = counts.get(length, 0) + count
+        return counts
+
+    def count_words(self, word_length=None):
+        """Returns the number of words, optionally only those of a length"""
+        return sum(count for _, count in
+                   self._matching_ranges(word_length, None))
+
+    def iter_words(self, word_length=None):
+        """Yields the words of the list, optionally only those of a length,
+        reading them from the buffer one at a time"""
+        for first, count in self._matching_ranges(word_length, None):
+            for index in range(first, first + count):
+                yield self.word(index)
+
+    def _matching_ranges(self, word_length, difficulty):
+        """Returns the (first index, count) of each bucket matching a length
+        and difficulty, either of which may be None"""
+        key = (word_length, difficulty)
+        if key not in self._ranges:
+            if difficulty:
+                # An unknown difficulty matches no bucket.
+                low, high = DIFFICULTY_DISTINCT_LETTERS.get(difficulty, (1, 0))
+            else:
+                low, high = 0, 255
+            self._ranges[key] = tuple(
+                (first, count)
+                for length, distinct, first, count in self._buckets
+                if (not word_length or length == word_length) and
+                low <= distinct <= high)
+        return self._ranges[key]
+
+    def choose(self, word_length=None, difficulty=None):
+        """Returns a random word matching the optional length and difficulty.
+        Args:
+            word_length: The exact number of letters the word must have
+            difficulty: One of the DIFFICULTY_* levels
+        Returns:
+            A random word from the matching buckets.
+        Raises:
+            ValueError: If no word matches the requested length and
+                difficulty."""
+        ranges = self._matching_ranges(word_length, difficulty)
+        total = sum(count for _, count in ranges)
+        if not total:
+            raise ValueError('No word matches the requested length and '
+                             'difficulty')
+        index = random.randrange(total)
+        for first, count in ranges:
+            if index < count:
+                return self.word(first + index)
+            index -= count
+
+
+def open_packed(path):
+    """Returns a WordBank of a packed word list file, memory-mapped when
+    mmap is available"""
+    with open(path, 'rb') as packed_file:
+        if mmap is not None:
+            return WordBank(mmap.mmap(packed_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ))
+        return WordBank(packed_file.read())
+
+
+_word_bank = None
+
+
+def get_word_bank():
+    """Returns the instance wide WordBank of the deployed word list, opening
+    words.bin on first use. Falls back to packing words.json in memory when
+    words.bin has not been built."""
+    global _word_bank
+    if _word_bank is None:
+        if os.path.exists(PACKED_WORDS_FILE):
+            _word_bank = open_packed(PACKED_WORDS_FILE)
+        else:
+            with open(WORDS_FILE) as words_file:
+                _word_bank = WordBank.from_words(json.load(words_file))
+    return _word_bank
+
+
+def choose_word(word_length=None, difficulty=None):
+    """Returns a random word from the instance wide WordBank"""
+    return get_word_bank().choose(word_length, difficulty)